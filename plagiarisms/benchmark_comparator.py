@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+#
+# Benchmark of comparator engines. The external comparator and the native engine are executed on the same corpus
+# (the last processed batch of an exercise compared with its archive without the batch itself); their running times
+# and results are compared.
+#
+
+import argparse
+import os
+import csv
+import time
+import tempfile
+from config import load_config
+from files import FilesManager
+from comparator import Comparator, NativeComparator
+
+
+class BenchmarkFilesManager(FilesManager):
+    '''
+    Files manager that presents the last processed batch as the working batch and redirects outputs to a temp dir.
+    '''
+
+    def __init__(self, config, exercise, output_dir):
+        super().__init__(config, exercise)
+        self.working_dir = self.last_dir
+        self.output_dir = output_dir
+        self.output_file = output_dir + '/output.csv'
+
+    def get_comparator_output_file(self):
+        return self.output_file
+
+    def get_delta_manifest_file(self):
+        return self.output_dir + '/delta.csv'
+
+    def get_benchmark_base_file(self):
+        return self.archive_dir + '/benchmark-base.csv'  # paths in archive manifests are relative to archive dir
+
+
+def load_pairs(comparator):
+    '''
+    Return the number of output rows and a set of detected (tested file, similar file) pairs.
+    '''
+    columns = comparator.get_output_columns()
+    rows = 0
+    pairs = set()
+    with open(comparator.get_output_file(), 'r', encoding="utf8", newline='') as f:
+        for row in csv.DictReader(f, **comparator.get_output_csv_params()):
+            rows += 1
+            pairs.add((row[columns['file_id1']], row[columns['file_id2']]))
+    return rows, pairs
+
+
+def run_engine(label, comparator, files, header, rows, references=None):
+    files.output_file = files.output_dir + '/' + label + '.csv'
+    start = time.perf_counter()
+    comparator.prepare(header, rows)
+    comparator.references = references
+    prepared = time.perf_counter()
+    if not comparator.run():
+        raise RuntimeError("The {} comparator failed.".format(label))
+    end = time.perf_counter()
+
+    output_rows, pairs = load_pairs(comparator)
+    print("{:>8}: prepare {:8.2f}s, run {:8.2f}s, {} output rows, {} file pairs".format(
+        label, prepared - start, end - prepared, output_rows, len(pairs)))
+    return pairs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("exercise", type=str, help="Identifier of the exercise (its last batch is the corpus).")
+    parser.add_argument("--config", type=str,
+                        help="Path to yaml file with simulation configuration (./config.yaml is default).")
+    parser.add_argument("--skip-external", default=False, action="store_true",
+                        help="Benchmark only the native engine.")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    comparator_config = dict(config['comparator'])
+    comparator_config['delta'] = {'enabled': False}  # the last batch is already merged in the archive
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        files = BenchmarkFilesManager(config['dirs'], args.exercise, output_dir)
+        with open(files.get_working_manifest_file(), 'r', encoding="utf8") as f:
+            reader = csv.DictReader(f)
+            header = list(reader.fieldnames)
+            rows = list(reader)
+        print("Corpus: {} files of the last batch, archive {}".format(len(rows), files.get_archive_dir()))
+
+        native = run_engine('native', NativeComparator(comparator_config, files, args.exercise), files, header, rows)
+        if not args.skip_external:
+            # the native engine skips the working solutions in the archive, the external one gets them removed
+            batch = set(row['solution_id'] for row in rows)
+            base_file = files.get_benchmark_base_file()
+            files.get_archive_index().export_csv(base_file, lambda row: row['solution_id'] not in batch)
+            try:
+                external = run_engine('external', Comparator(comparator_config, files, args.exercise), files, header,
+                                      rows, {'archive': base_file})
+            finally:
+                os.unlink(base_file)
+            common = len(native & external)
+            print("Pairs found by both engines: {}, only native: {}, only external: {}".format(
+                common, len(native) - common, len(external) - common))
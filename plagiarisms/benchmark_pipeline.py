@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+
+#
+# Benchmark of the whole detection pipeline on a synthetic corpus. ReCodEx is replaced by a local stand-in for
+# the recodex CLI (it serves generated solutions, records all calls, and simulates latency) and the comparator
+# by a stub that emits a configurable number of output rows. The first run lays the archive, the second one
+# (with new solutions) is measured -- stage times, peak RSS, API calls, and throughput are reported.
+#
+
+import os
+import sys
+import json
+import random
+import argparse
+import resource
+import tempfile
+from config import load_config
+from detection_manager import run_detection
+
+EXERCISE = 'bench'
+EXERCISE_ID = 'bench-exercise'
+
+# Stand-in for the recodex CLI. The corpus (solutions.json and files of solutions) is in BENCHMARK_CORPUS dir.
+FAKE_RECODEX = r'''#!/usr/bin/env python3
+import os, sys, json, time, zipfile
+corpus = os.environ['BENCHMARK_CORPUS']
+args = sys.argv[1:]
+with open(os.environ['BENCHMARK_LOG'], 'a') as fp:
+    fp.write(json.dumps(args[:2]) + "\n")
+time.sleep(float(os.environ.get('BENCHMARK_LATENCY', '0')))
+with open(corpus + '/solutions.json') as fp:
+    data = json.load(fp)
+command = args[:2]
+if command == ['groups', 'all']:
+    result = [{'id': 'group', 'archived': False, 'childGroups': [], 'primaryAdminsIds': ['admin'],
+               'privateData': {'assignments': sorted(set(s['assignment'] for s in data['solutions']))}}]
+elif command == ['groups', 'assignments']:
+    result = [{'id': id, 'exerciseId': data['exercise']}
+              for id in sorted(set(s['assignment'] for s in data['solutions']))]
+elif command == ['assignments', 'get-solutions']:
+    result = [{'id': s['id'], 'authorId': s['author'], 'createdAt': s['createdAt'], 'accepted': True}
+              for s in data['solutions'] if s['assignment'] == args[2]]
+elif command == ['users', 'get']:
+    result = {'id': args[2], 'name': {'firstName': 'User', 'lastName': args[2]}}
+elif command == ['users', 'get-list']:
+    result = [{'id': id, 'name': {'firstName': 'User', 'lastName': id}} for id in sys.stdin.read().split()]
+elif command == ['solutions', 'get-files']:
+    result = [{'id': args[2] + '-' + name, 'name': name} for name in sorted(os.listdir(corpus + '/' + args[2]))]
+elif command == ['solutions', 'download']:
+    with zipfile.ZipFile(args[3], 'w') as zip:
+        for name in os.listdir(corpus + '/' + args[2]):
+            zip.write(corpus + '/' + args[2] + '/' + name, name)
+    sys.exit(0)
+elif command == ['plagiarisms', 'create-batch']:
+    print('benchmark-batch')
+    sys.exit(0)
+elif command == ['plagiarisms', 'add-similarity'] or command == ['plagiarisms', 'update-batch']:
+    sys.stdin.read()
+    sys.exit(0)
+else:
+    sys.stderr.write("Unknown command {}\n".format(args))
+    sys.exit(1)
+print(json.dumps(result))
+'''
+
+# Stand-in for the in-process client of recodex-cli (package recodex), it serves the same corpus as the fake CLI.
+FAKE_CLIENT_FACTORY = r'''import os, io, json, time, zipfile
+
+
+class Response:
+    def __init__(self, payload, data=None):
+        self.payload = payload
+        self.data = data
+
+    def get_payload(self):
+        return self.payload
+
+    def get_data_binary(self):
+        return self.data
+
+    def check_success(self):
+        pass
+
+
+class Client:
+    def send_request_by_callback(self, callback, path_params=None, query_params=None, body=None):
+        corpus = os.environ['BENCHMARK_CORPUS']
+        with open(os.environ['BENCHMARK_LOG'], 'a') as fp:
+            fp.write(json.dumps(['client', callback]) + "\n")
+        time.sleep(float(os.environ.get('BENCHMARK_LATENCY', '0')))
+        with open(corpus + '/solutions.json') as fp:
+            data = json.load(fp)
+        id = (path_params or {}).get('id')
+        assignments = sorted(set(s['assignment'] for s in data['solutions']))
+        if callback == 'groups_presenter_action_default':
+            return Response([{'id': 'group', 'archived': False, 'childGroups': [], 'primaryAdminsIds': ['admin'],
+                              'privateData': {'assignments': assignments}}])
+        if callback == 'groups_presenter_action_assignments':
+            return Response([{'id': a, 'exerciseId': data['exercise']} for a in assignments])
+        if callback == 'assignments_presenter_action_solutions':
+            return Response([{'id': s['id'], 'authorId': s['author'], 'createdAt': s['createdAt'], 'accepted': True}
+                             for s in data['solutions'] if s['assignment'] == id])
+        if callback == 'users_presenter_action_list_by_ids':
+            return Response([{'id': id, 'name': {'firstName': 'User', 'lastName': id}} for id in body['ids']])
+        if callback == 'users_presenter_action_detail':
+            return Response({'id': id, 'name': {'firstName': 'User', 'lastName': id}})
+        if callback == 'assignment_solutions_presenter_action_files':
+            return Response([{'id': id + '-' + name, 'name': name} for name in sorted(os.listdir(corpus + '/' + id))])
+        if callback == 'assignment_solutions_presenter_action_download_solution_archive':
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w') as zip:
+                for name in os.listdir(corpus + '/' + id):
+                    zip.write(corpus + '/' + id + '/' + name, name)
+            return Response(None, buffer.getvalue())
+        return Response(None)
+
+
+def get_client_from_session():
+    return Client()
+'''
+
+FAKE_SWAGGER_CLIENT = r'''class _Callbacks(type):
+    def __getattr__(cls, name):
+        return name  # callbacks are identified by their names
+
+
+class DefaultApi(metaclass=_Callbacks):
+    pass
+'''
+
+# Stub comparator -- emits given number of rows (grouped by tested files) pairing tested files with other files.
+STUB_COMPARATOR = r'''#!/usr/bin/env python3
+import os, sys, csv
+args = sys.argv[1:]
+def arg(name):
+    return args[args.index(name) + 1] if name in args else None
+def load(file):
+    with open(file, encoding='utf8', newline='') as fp:
+        return list(csv.DictReader(fp))
+tested = load(arg('--csv'))
+others = tested + (load(arg('--csv-base')) if arg('--csv-base') else [])
+rows = int(arg('--rows'))
+with open(arg('--csv-output'), 'w', encoding='utf8', newline='') as fp:
+    writer = csv.writer(fp)
+    writer.writerow(['author_id_2', 'percentage_1', 'file_id_1', 'solution_id_1', 'byte_position_1', 'byte_size_1',
+                     'file_id_2', 'solution_id_2', 'byte_position_2', 'byte_size_2'])
+    per_file = max(1, rows // max(1, len(tested)))
+    written = 0
+    for i, row in enumerate(tested):
+        for j in range(per_file if i < len(tested) - 1 else rows - written):
+            other = others[(i * 7919 + j * 104729) % len(others)]
+            writer.writerow([other['author_id'], 50 + j % 50, row['file_id'], row['solution_id'], j * 10, 50,
+                             other['file_id'], other['solution_id'], j * 20, 50])
+            written += 1
+        if written >= rows:
+            break
+'''
+
+
+def generate_code(rnd, size):
+    '''
+    Generate a pseudo-random C-like source code of approximately given size.
+    '''
+    lines = []
+    total = 0
+    while total < size:
+        name = 'v' + str(rnd.randrange(1000))
+        line = "    int {} = {} * {} + {};".format(name, rnd.randrange(100), 'x' + str(rnd.randrange(50)),
+                                                   rnd.randrange(1000))
+        if rnd.random() < 0.2:
+            line = "    for (int i = 0; i < {}; ++i) {{ {} += i; }}".format(rnd.randrange(100), name)
+        lines.append(line)
+        total += len(line) + 1
+    return "int main() {\n" + "\n".join(lines) + "\n}\n"
+
+
+def generate_corpus(dir, count, start, args, rnd, solutions):
+    '''
+    Add `count` solutions (with files) to the corpus dir and to the list of solutions (which is saved).
+    Some solutions are copies of previous ones (plagiarisms).
+    '''
+    for i in range(start, start + count):
+        id = "solution{:06d}".format(i)
+        os.makedirs(dir + '/' + id)
+        source = rnd.choice(solutions)['id'] if solutions and rnd.random() < args.plagiarism_rate else None
+        for f in range(args.files):
+            name = "file{}.c".format(f)
+            if source is not None:
+                with open(dir + '/' + source + '/' + name, 'r') as fp:
+                    code = fp.read()
+            else:
+                code = generate_code(rnd, args.file_size)
+            with open(dir + '/' + id + '/' + name, 'w') as fp:
+                fp.write(code)
+        solutions.append({
+            'id': id,
+            'author': "user{:05d}".format(rnd.randrange(args.users)),
+            'assignment': "assignment{}".format(i % args.assignments),
+            'createdAt': 1600000000 + i * 60,
+        })
+
+    with open(dir + '/solutions.json', 'w') as fp:
+        json.dump({
+            'exercise': EXERCISE_ID,
+            'users': ["user{:05d}".format(u) for u in range(args.users)],
+            'solutions': solutions,
+        }, fp)
+
+
+def prepare_config(base_dir, bin_dir, args):
+    '''
+    Create detection config for the synthetic environment (user config may provide uploader, downloader mode, ...).
+    '''
+    config = load_config(args.config) if args.config else {}
+    config['exercises'] = {EXERCISE: EXERCISE_ID}
+    config['groups'] = [{'id': 'group'}]
+    config['manifest'] = {'path': 'path', 'file_id': 'file.id', 'author_id': 'solution.authorId'}
+    config['solutions'] = {}
+    config['dirs'] = {name: base_dir + '/' + name for name in ['working', 'last_batch', 'archive', 'logs', 'metrics']}
+    config['logger'] = {'console_level': None, 'file_level': 'INFO'}
+    downloader = config.get('downloader', {})
+    config['downloader'] = dict(downloader, python=sys.executable,
+                                exec=os.path.dirname(os.path.abspath(__file__)) + '/../solution-downloader/download.py')
+    if downloader.get('user_cache'):
+        config['downloader']['user_cache'] = dict(downloader['user_cache'], file=base_dir + '/users-cache.json')
+
+    comparator = dict(config.get('comparator', {}))
+    comparator['engine'] = args.engine
+    comparator.setdefault('name', 'benchmark')
+    comparator['exec'] = bin_dir + '/comparator'
+    comparator['args'] = {
+        'manifest': ['--csv', '{}'],
+        'archive': ['--csv-base', '{}'],
+        'output': ['--csv-output', '{}'],
+        'other': ['--rows', str(args.output_rows)],
+    }
+    comparator['exercise_args'] = {}
+    comparator['output'] = dict(comparator.get('output', {}), sorted=True, columns={
+        'author_id': 'author_id_2',
+        'similarity': 'percentage_1',
+        'file_id1': 'file_id_1',
+        'solution_id1': 'solution_id_1',
+        'offset1': 'byte_position_1',
+        'length1': 'byte_size_1',
+        'file_id2': 'file_id_2',
+        'solution_id2': 'solution_id_2',
+        'offset2': 'byte_position_2',
+        'length2': 'byte_size_2',
+    })
+    config['comparator'] = comparator
+    return config
+
+
+def load_api_calls(log_file):
+    calls = {}
+    if os.path.exists(log_file):
+        with open(log_file, 'r') as fp:
+            for line in fp:
+                command = ' '.join(json.loads(line))
+                calls[command] = calls.get(command, 0) + 1
+    return calls
+
+
+def load_last_metrics(metrics_dir):
+    files = sorted(file for file in os.listdir(metrics_dir) if file.endswith('.json'))
+    with open(metrics_dir + '/' + files[-1], 'r') as fp:
+        return json.load(fp)
+
+
+def report(metrics, calls, args):
+    print("Stage             wall [s]    cpu [s]")
+    for name, stage in metrics['stages'].items():
+        print("{:<16} {:>9.2f} {:>10.2f}".format(name, stage['wall'], stage['cpu']))
+    total = sum(stage['wall'] for stage in metrics['stages'].values())
+    print("{:<16} {:>9.2f}".format('total', total))
+
+    print("\nCounters:")
+    for name, value in sorted(metrics['counters'].items()):
+        print("  {:<28} {}".format(name, value))
+
+    print("\nAPI calls (recodex CLI and client):")
+    for command, count in sorted(calls.items(), key=lambda item: -item[1]):
+        print("  {:<44} {}".format(command, count))
+
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print("\nPeak RSS: manager {:.1f} MiB, largest child process {:.1f} MiB".format(
+        self_rss / 1024, children_rss / 1024))
+
+    if total > 0:
+        counters = metrics['counters']
+        print("Throughput: {:.1f} solutions/s, {:.1f} output rows/s, {:.1f} uploaded records/s".format(
+            counters.get('solutions_downloaded', 0) / total, counters.get('rows_parsed', 0) / total,
+            counters.get('records_uploaded', 0) / total))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str,
+                        help="Config whose settings (uploader, downloader mode, comparator output, ...) are used.")
+    parser.add_argument("--archive", type=int, default=200, help="Number of archived solutions.")
+    parser.add_argument("--solutions", type=int, default=50, help="Number of new solutions.")
+    parser.add_argument("--files", type=int, default=2, help="Number of files of each solution.")
+    parser.add_argument("--file-size", type=int, default=2000, help="Approximate size of a file in bytes.")
+    parser.add_argument("--users", type=int, default=100, help="Number of distinct authors.")
+    parser.add_argument("--assignments", type=int, default=3, help="Number of assignments.")
+    parser.add_argument("--plagiarism-rate", type=float, default=0.1, help="Fraction of copied solutions.")
+    parser.add_argument("--output-rows", type=int, default=10000, help="Number of rows emitted by the stub comparator.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated latency of each API call [s].")
+    parser.add_argument("--engine", type=str, default='external', help="Comparator engine (external or native).")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the corpus generator.")
+    parser.add_argument("--keep", type=str, help="New directory where the benchmark data are kept (temp dir is used otherwise).")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        base_dir = os.path.abspath(args.keep or temp_dir)
+        bin_dir = base_dir + '/bin'
+        corpus_dir = base_dir + '/corpus'
+        os.makedirs(bin_dir)
+        os.makedirs(corpus_dir)
+        for name, script in [('recodex', FAKE_RECODEX), ('comparator', STUB_COMPARATOR)]:
+            with open(bin_dir + '/' + name, 'w') as fp:
+                fp.write(script)
+            os.chmod(bin_dir + '/' + name, 0o755)
+        lib_dir = base_dir + '/lib'
+        for name, module in [('recodex/__init__.py', ''), ('recodex/client_factory.py', FAKE_CLIENT_FACTORY),
+                             ('recodex/generated/__init__.py', ''),
+                             ('recodex/generated/swagger_client/__init__.py', FAKE_SWAGGER_CLIENT)]:
+            os.makedirs(os.path.dirname(lib_dir + '/' + name), exist_ok=True)
+            with open(lib_dir + '/' + name, 'w') as fp:
+                fp.write(module)
+
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [lib_dir, os.environ.get('PYTHONPATH')]))
+        sys.path.insert(0, lib_dir)  # library mode and the client upload backend
+        os.environ['BENCHMARK_CORPUS'] = corpus_dir
+        os.environ['BENCHMARK_LOG'] = base_dir + '/api-calls.log'
+        os.environ['BENCHMARK_LATENCY'] = str(args.latency)
+        config = prepare_config(base_dir, bin_dir, args)
+
+        rnd = random.Random(args.seed)
+        solutions = []
+        print("Generating archive of {} solutions ...".format(args.archive))
+        generate_corpus(corpus_dir, args.archive, 0, args, rnd, solutions)
+        if run_detection(config, EXERCISE) != 0:
+            raise RuntimeError("Initial detection (archive) failed.")
+
+        print("Generating {} new solutions ...".format(args.solutions))
+        generate_corpus(corpus_dir, args.solutions, args.archive, args, rnd, solutions)
+        os.unlink(os.environ['BENCHMARK_LOG'])
+        if run_detection(config, EXERCISE) != 0:
+            raise RuntimeError("Measured detection failed.")
+
+        print()
+        report(load_last_metrics(config['dirs']['metrics']), load_api_calls(os.environ['BENCHMARK_LOG']), args)
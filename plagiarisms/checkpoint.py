@@ -0,0 +1,79 @@
+import os
+import json
+import time
+import threading
+
+
+class Checkpoint:
+    '''
+    Persistent progress of one detection run, stored in the working directory, so a failed run can be resumed.
+    Uploaded similarity records are identified by their index in the (deterministic) comparator output.
+    '''
+
+    def __init__(self, file, save_interval=1.0):
+        self.file = file
+        self.save_interval = save_interval  # min. delay between saves triggered by uploaded records
+        self.last_save = 0
+        self.lock = threading.Lock()
+        self.data = {
+            'downloaded': False,
+            'compared': False,
+            'batch_id': None,
+            'uploaded': 0,  # all records with lower indices are uploaded
+            'uploaded_extra': [],  # uploaded records beyond the contiguous prefix (parallel uploads finish unordered)
+            'upload_completed': False,  # the batch is closed
+            'merged': False,
+        }
+        if os.path.exists(file):
+            with open(file, 'r', encoding="utf8") as fp:
+                self.data.update(json.load(fp))
+        self.extra = set(self.data['uploaded_extra'])
+
+    def exists(self):
+        return os.path.exists(self.file)
+
+    def _save(self):
+        self.data['uploaded_extra'] = sorted(self.extra)
+        tmp = self.file + '.tmp'
+        with open(tmp, 'w', encoding="utf8") as fp:
+            json.dump(self.data, fp)
+        os.replace(tmp, self.file)
+        self.last_save = time.monotonic()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def get(self, key):
+        with self.lock:
+            return self.data[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self._save()
+
+    def reset_upload(self):
+        '''
+        Forget the upload progress (e.g., when the comparator output is re-generated).
+        '''
+        with self.lock:
+            self.data.update({'batch_id': None, 'uploaded': 0, 'upload_completed': False})
+            self.extra = set()
+            self._save()
+
+    def is_uploaded(self, index):
+        with self.lock:
+            return index < self.data['uploaded'] or index in self.extra
+
+    def mark_uploaded(self, index):
+        '''
+        Record uploaded similarity (thread safe). The file is saved at most once per save_interval.
+        '''
+        with self.lock:
+            self.extra.add(index)
+            while self.data['uploaded'] in self.extra:
+                self.extra.remove(self.data['uploaded'])
+                self.data['uploaded'] += 1
+            if time.monotonic() - self.last_save >= self.save_interval:
+                self._save()
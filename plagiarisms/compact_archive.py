@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+#
+# Compaction of solution archives. A retention policy (configured in the `retention` section) selects solutions
+# that are kept in the archive of an exercise, the manifest is rewritten (without duplicate rows), and files
+# of all other solutions are removed from the archive, the fingerprint index, and the content-addressed store.
+# The store is shared by all exercises, so unreferenced objects are collected only when all exercises are compacted
+# (--all). Compaction must not run concurrently with detections.
+#
+
+import os
+import time
+import argparse
+from datetime import datetime
+from config import load_config
+from files import FilesManager
+from comparator import create_comparator
+
+
+def _parse_timestamp(value):
+    '''
+    Parse a date from the manifest (unix timestamp or ISO date string), return None if it cannot be parsed.
+    '''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('-inf')
+
+
+def select_solutions(rows, retention, header):
+    '''
+    Apply the retention policy on archive manifest rows and return a set of IDs of the solutions that are kept.
+    Solutions with missing (unparseable) dates are always kept.
+    '''
+    date_col = retention.get('date_column', 'submitted')
+    years = retention.get('years')
+    per_author = retention.get('per_author')
+    score_col = retention.get('score_column', 'points')
+
+    required = [date_col] if years or per_author else []
+    if per_author:
+        required += ['author_id', 'assignment_id'] + ([score_col] if per_author == 'best' else [])
+    for col in required:
+        if col not in header:
+            raise RuntimeError("Retention policy needs column '{}' which is not in the archive manifest.".format(col))
+    if per_author not in [None, 'best', 'latest']:
+        raise RuntimeError("Unknown per_author retention '{}' (use 'best' or 'latest').".format(per_author))
+
+    solutions = {}  # solution ID -> first row (all rows of a solution hold the same solution attributes)
+    for row in rows:
+        solutions.setdefault(row['solution_id'], row)
+
+    kept = set(solutions)
+    if years:
+        min_ts = time.time() - years * 365.25 * 86400
+        for solution_id, row in solutions.items():
+            created = _parse_timestamp(row[date_col])
+            if created is not None and created < min_ts:
+                kept.discard(solution_id)
+
+    if per_author:
+        groups = {}
+        for solution_id in kept:
+            row = solutions[solution_id]
+            groups.setdefault((row['author_id'], row['assignment_id']), []).append(solution_id)
+
+        def rank(solution_id):
+            row = solutions[solution_id]
+            created = _parse_timestamp(row[date_col]) or 0
+            if per_author == 'best':
+                return (_parse_number(row[score_col]), created, solution_id)
+            return (created, solution_id)
+
+        kept = set(max(group, key=rank) for group in groups.values())
+
+    return kept
+
+
+def compact_archive(config, exercise, dry_run=False):
+    '''
+    Compact the archive of one exercise according to the retention policy. Returns an exit code (0 on success).
+    '''
+    file_manager = FilesManager(config['dirs'], exercise)
+    if file_manager.working_dir_exists():
+        print("Working directory {} exists, the detection is running or it has failed. Compaction is not possible.".format(
+            file_manager.get_working_dir()))
+        return 1
+    if not os.path.exists(file_manager.get_archive_manifest_file()):
+        print("Exercise {} has no archive yet.".format(exercise))
+        return 0
+
+    archive = file_manager.get_archive_index()
+    header = archive.get_header()
+    rows = list(archive.get_rows())
+    kept = select_solutions(rows, config.get('retention', {}), header)
+
+    new_rows = []
+    seen = set()
+    for row in rows:
+        key = tuple(row[col] for col in header)
+        if row['solution_id'] in kept and key not in seen:
+            seen.add(key)
+            new_rows.append(row)
+
+    removed = set(archive.get_solutions()) - kept
+    unreferenced = [dir for dir in file_manager.get_archived_solution_dirs() if dir not in kept]
+    print("Exercise {}: {} of {} rows kept, {} solutions removed, {} solution dirs to delete.".format(
+        exercise, len(new_rows), len(rows), len(removed), len(unreferenced)))
+    if dry_run:
+        return 0
+
+    file_manager.replace_archive_manifest(header, new_rows)
+    for dir in unreferenced:
+        file_manager.remove_archived_solution(dir)
+    create_comparator(config.get("comparator", {}), file_manager, exercise).remove_archived_solutions(removed)
+    return 0
+
+
+if __name__ == "__main__":
+    # Process program arguments...
+    parser = argparse.ArgumentParser()
+    parser.add_argument("exercise", type=str, nargs='?', help="Identifier of the exercise.")
+    parser.add_argument("--config", type=str,
+                        help="Path to yaml file with simulation configuration (./config.yaml is default).")
+    parser.add_argument("--all", default=False, action="store_true",
+                        help="Compact archives of all exercises from the config (exercise argument is ignored) "
+                        "and remove unreferenced objects from the shared store.")
+    parser.add_argument("--dry-run", default=False, action="store_true",
+                        help="Only print what would be removed.")
+    args = parser.parse_args()
+
+    # Load configuration
+    config = load_config(args.config)
+    if args.all:
+        exercises = list(config['exercises'])
+    elif args.exercise in config.get('exercises', {}):
+        exercises = [args.exercise]
+    else:
+        print("Invalid exercise identifier '{}'. Config holds exercises '{}'.".format(
+            args.exercise, "', '".join(config['exercises'].keys())))
+        exit(1)
+
+    result = 0
+    for exercise in exercises:
+        result = max(result, compact_archive(config, exercise, args.dry_run))
+
+    if args.all and not args.dry_run and result == 0:  # the store is shared by all exercises
+        count, size = FilesManager(config['dirs'], exercises[0]).collect_store_garbage()
+        print("{} unreferenced objects ({} bytes) removed from the store.".format(count, size))
+    elif not args.all:
+        print("The store is shared by all exercises, its unreferenced objects are removed only with --all.")
+    exit(result)
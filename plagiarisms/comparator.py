@@ -1,6 +1,45 @@
 import os
+import csv
+import time
+import shutil
 import logging
+import threading
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from fingerprints import FingerprintIndex, fingerprint_file, merge_fragments, coverage
+import metrics
+
+# keys of the output columns (in the order in which the native engine writes them)
+OUTPUT_KEYS = ['author_id', 'similarity', 'file_id1', 'solution_id1', 'offset1', 'length1',
+               'file_id2', 'solution_id2', 'offset2', 'length2']
+
+
+def follow_file(file_name, running, poll_interval=0.2):
+    '''
+    Generator yielding lines of a text file while it is being written by someone else.
+    It waits for more data while running() returns true, the rest of the file is yielded once the writer is done.
+    '''
+    while not os.path.exists(file_name):
+        if not running():
+            return
+        time.sleep(poll_interval)
+
+    with open(file_name, 'r', encoding="utf8", newline='') as f:
+        buffer = ''
+        while True:
+            finished = not running()  # checked before reading, so no data written afterwards are lost
+            chunk = f.read(1024 * 1024)
+            if chunk:
+                buffer += chunk
+                end = buffer.rfind('\n') + 1  # only complete lines are yielded
+                yield from buffer[:end].splitlines(keepends=True)
+                buffer = buffer[end:]
+            elif finished:
+                if buffer:
+                    yield buffer
+                return
+            else:
+                time.sleep(poll_interval)
 
 
 class Comparator:
@@ -15,22 +54,35 @@ class Comparator:
         self.files = files
 
         self.name = config['name']
-        self.exec = config['exec']
+        self.exec = config.get('exec')
         self.output_csv = config['output'].get('csv', {})
         self.output_columns = config['output']['columns']
+        self.output_sorted = config['output'].get('sorted', False)
+        self.output_sort_chunk = config['output'].get('sort_chunk_rows', 1000000)
+        self.output_pruning = config['output'].get('pruning', {})
+        self.pipelined = config.get('pipelined', False)
+        self.shards = config.get('shards', {})
 
         # prepare actual arguments
-        self.args = config.get('args', {})
+        self.args = dict(config.get('args', {}))  # copy, so the overrides do not leak into other exercises
         exercise_args = config.get('exercise_args', {}).get(exercise, {})
         for key in exercise_args:
             self.args[key] = exercise_args[key]  # override base args
 
+        # delta mode (only new solutions are tested, only relevant part of the archive is used as base)
+        self.delta = config.get('delta', {})
+        self.fingerprints = config.get('fingerprints', {})
+        self.fingerprint_index = None
+        self.references = None  # overrides of input files prepared for delta mode
+        self.prefetched = {}  # file -> future of (size, fingerprints) computed while the download is running
+        self.prefetch_executor = None
+
     def get_name(self):
         return self.name
 
-    def get_args(self):
+    def _get_references(self):
         '''
-        Assemble the arguments and return them as a list of strings.
+        Return paths to input/output files that are injected into the arguments.
         '''
         references = {
             'manifest': self.files.get_working_manifest_file(),
@@ -38,6 +90,15 @@ class Comparator:
         }
         if os.path.exists(self.files.get_archive_manifest_file()):
             references['archive'] = self.files.get_archive_manifest_file()
+        references.update(self.references or {})
+        return references
+
+    def get_args(self, references=None):
+        '''
+        Assemble the arguments and return them as a list of strings.
+        Given references override the default input/output files (e.g., for individual shards).
+        '''
+        references = dict(self._get_references(), **(references or {}))
 
         args = self.args.get('other', []).copy()
         for name in references:
@@ -45,6 +106,132 @@ class Comparator:
 
         return args
 
+    def is_delta_enabled(self):
+        return self.delta.get('enabled', False)
+
+    def _uses_fingerprint_index(self):
+        return self.is_delta_enabled()
+
+    def _get_fingerprint_params(self):
+        '''
+        Return (k, window, normalize) parameters of fingerprinting.
+        '''
+        return (self.fingerprints.get('k', 12), self.fingerprints.get('window', 8),
+                self.fingerprints.get('normalize', True))
+
+    def _get_fingerprint_index(self):
+        if self.fingerprint_index is None:
+            self.fingerprint_index = FingerprintIndex(self.files.get_fingerprint_index_file(),
+                                                      *self._get_fingerprint_params())
+        return self.fingerprint_index
+
+    def prefetch(self, rows):
+        '''
+        Hook invoked with manifest rows of each downloaded solution while the download is still running.
+        If the comparison needs fingerprints, they are computed in background processes right away.
+        '''
+        if not self._uses_fingerprint_index():
+            return
+        if self.prefetch_executor is None:
+            self.prefetch_executor = ProcessPoolExecutor()
+        wd = self.files.get_working_dir()
+        for row in rows:
+            file = wd + '/' + row['path']
+            self.prefetched[file] = self.prefetch_executor.submit(_fingerprint_worker,
+                                                                  (file, self._get_fingerprint_params()))
+
+    def _get_fingerprints(self, files, workers=None, chunksize=1):
+        '''
+        Return a list of (size, fingerprints) of given files. Prefetched results are used, the remaining files
+        are fingerprinted in a pool of processes. The prefetched data are released afterwards.
+        '''
+        params = self._get_fingerprint_params()
+        missing = [file for file in files if file not in self.prefetched]
+        computed = {}
+        if missing:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                computed = dict(zip(missing, executor.map(_fingerprint_worker, [(file, params) for file in missing],
+                                                          chunksize=chunksize)))
+
+        result = [computed[file] if file in computed else self.prefetched[file].result() for file in files]
+        metrics.increment('files_prefetched', len(files) - len(missing))
+        self.close()
+        return result
+
+    def close(self):
+        '''
+        Stop the background processes computing prefetched fingerprints and release their results.
+        Invoked when the run ends (prefetched files may not be compared, e.g., if nothing new was found or it failed).
+        '''
+        if self.prefetch_executor is not None:
+            self.prefetch_executor.shutdown()
+            self.prefetch_executor = None
+        self.prefetched = {}
+
+    def update_archive_index(self, rows=None):
+        '''
+        Add archived files into the fingerprint index (if the index is used).
+        Only given archive manifest rows (newly merged solutions) are added. If the index is empty, the whole archive
+        is indexed; without rows, nothing else is done (the index is kept up to date by the merges).
+        '''
+        if not self._uses_fingerprint_index() or not os.path.exists(self.files.get_archive_manifest_file()):
+            return
+
+        index = self._get_fingerprint_index()
+        if index.get_file_count() == 0:
+            logging.getLogger().debug("Building fingerprint index of the whole archive...")
+            rows = self.files.get_archive_index().get_rows()
+        elif rows is None:
+            return
+
+        for row in rows:
+            index.add_file(row['file_id'], row['solution_id'], row['author_id'],
+                           self.files.get_archive_dir() + '/' + row['path'])
+
+    def remove_archived_solutions(self, solution_ids):
+        '''
+        Remove files of given solutions (which are no longer in the archive) from the fingerprint index.
+        '''
+        if os.path.exists(self.files.get_fingerprint_index_file()):
+            self._get_fingerprint_index().remove_solutions(solution_ids)
+
+    def prepare(self, header, rows):
+        '''
+        Prepare comparator inputs for the working batch (given manifest header and rows).
+        In delta mode, only solutions which are not in the archive yet are tested and only the archived files
+        that share enough fingerprints with them are used as the code base.
+        '''
+        self.references = None
+        if not self.is_delta_enabled() or not os.path.exists(self.files.get_archive_manifest_file()):
+            return
+
+        archive = self.files.get_archive_index()
+        self.update_archive_index()  # make sure the index exists (built only if it is empty)
+
+        delta_rows = [row for row in rows if not archive.has_solution(row['solution_id'])]
+        with open(self.files.get_delta_manifest_file(), 'w', encoding="utf8", newline='') as fout:
+            writer = csv.DictWriter(fout, fieldnames=header)
+            writer.writeheader()
+            writer.writerows(delta_rows)
+
+        min_shared = self.delta.get('min_shared', 5)
+        candidates = {}
+        wd = self.files.get_working_dir()
+        for _, fingerprints in self._get_fingerprints([wd + '/' + row['path'] for row in delta_rows]):
+            hashes = [fp[0] for fp in fingerprints]
+            for file_id, count in self._get_fingerprint_index().count_shared(hashes).items():
+                if count >= min_shared:
+                    candidates[file_id] = True
+
+        archive.export_csv(self.files.get_delta_base_file(), lambda row: row['file_id'] in candidates)
+        logging.getLogger().debug("Delta mode: {} of {} rows tested, {} archived files selected as code base".format(
+            len(delta_rows), len(rows), len(candidates)))
+
+        self.references = {
+            'manifest': self.files.get_delta_manifest_file(),
+            'archive': self.files.get_delta_base_file(),
+        }
+
     def get_output_file(self):
         return self.files.get_comparator_output_file()
 
@@ -54,12 +241,354 @@ class Comparator:
     def get_output_columns(self):
         return self.output_columns
 
+    def is_output_sorted(self):
+        '''
+        True if the output rows of each tested file are contiguous (no external sort is needed).
+        '''
+        return self.output_sorted
+
+    def get_output_sort_chunk(self):
+        return self.output_sort_chunk
+
+    def get_output_pruning(self):
+        return self.output_pruning
+
+    def is_pipelined(self):
+        '''
+        True if the output should be processed while the comparator is still running.
+        '''
+        return self.pipelined
+
+    def run_streaming(self):
+        '''
+        Execute the comparator in a background thread and yield lines of its output as soon as they are written
+        (the output file is still created). Raises an exception at the end if the comparator fails.
+        '''
+        if os.path.exists(self.get_output_file()):
+            os.unlink(self.get_output_file())
+
+        result = {}
+        thread = threading.Thread(target=lambda: result.update(success=self.run()))
+        thread.start()
+        try:
+            yield from follow_file(self.get_output_file(), thread.is_alive)
+        finally:
+            thread.join()
+        if not result.get('success', False):
+            raise RuntimeError("The comparator failed.")
+
+    def get_shard_count(self):
+        return max(1, int(self.shards.get('count', 1)))
+
+    def _partition(self, rows):
+        '''
+        Split tested manifest rows into shards. Rows of one solution (or one assignment) always stay together,
+        groups are assigned greedily (largest first) to the shard with the fewest rows.
+        '''
+        key = 'assignment_id' if self.shards.get('by', 'solution') == 'assignment' else 'solution_id'
+        groups = {}
+        for row in rows:
+            groups.setdefault(row.get(key), []).append(row)
+
+        shards = [[] for _ in range(self.get_shard_count())]
+        for group in sorted(groups.values(), key=len, reverse=True):
+            min(shards, key=len).extend(group)
+        return [shard for shard in shards if shard]
+
+    def _get_cpu_affinity(self, shard, count):
+        '''
+        Return set of CPUs the process of given shard is pinned to (None = no pinning).
+        If cpu_affinity is true, the available CPUs are split evenly among the shards,
+        a list of CPU lists (one per shard) may be used for explicit pinning.
+        '''
+        affinity = self.shards.get('cpu_affinity', False)
+        if not affinity or not hasattr(os, 'sched_setaffinity'):
+            return None
+        if isinstance(affinity, list):
+            return set(affinity[shard % len(affinity)])
+
+        cpus = sorted(os.sched_getaffinity(0))
+        if count >= len(cpus):
+            return {cpus[shard % len(cpus)]}
+        return set(cpus[shard * len(cpus) // count:(shard + 1) * len(cpus) // count])
+
+    def _prepare_shards(self):
+        '''
+        Split the tested manifest and write inputs of individual comparator processes into the shards dir.
+        Each shard tests its own rows against the code base extended by the rows of all the other shards,
+        so all pairs are compared exactly as in a single run. Paths are rewritten relative to the shards dir.
+        Note that every shard process loads (tokenizes) the whole code base, so sharding splits only the comparison
+        of tested files -- it pays off when the batch is large relative to the (delta) code base.
+        Returns a list of references (manifest, archive, output) of the shards.
+        '''
+        dir = self.files.get_shards_dir()
+        if os.path.exists(dir):
+            shutil.rmtree(dir)
+        os.makedirs(dir)
+
+        def load(file):
+            base_dir = os.path.dirname(file)
+            with open(file, 'r', encoding="utf8", newline='') as fp:
+                reader = csv.DictReader(fp)
+                rows = []
+                for row in reader:
+                    row['path'] = os.path.relpath(base_dir + '/' + row['path'], dir)
+                    rows.append(row)
+                return reader.fieldnames or [], rows
+
+        references = self._get_references()
+        header, rows = load(references['manifest'])
+        base_header, base_rows = load(references['archive']) if 'archive' in references else (header, [])
+        base_header = base_header + [key for key in header if key not in base_header]
+
+        shards = self._partition(rows)
+        result = []
+        for i, shard in enumerate(shards):
+            shard_refs = {
+                'manifest': "{}/manifest-{}.csv".format(dir, i),
+                'archive': "{}/base-{}.csv".format(dir, i),
+                'output': "{}/output-{}.csv".format(dir, i),
+            }
+            with open(shard_refs['manifest'], 'w', encoding="utf8", newline='') as fout:
+                writer = csv.DictWriter(fout, fieldnames=header)
+                writer.writeheader()
+                writer.writerows(shard)
+            with open(shard_refs['archive'], 'w', encoding="utf8", newline='') as fout:
+                writer = csv.DictWriter(fout, fieldnames=base_header, restval='')
+                writer.writeheader()
+                writer.writerows(base_rows)
+                for j, other in enumerate(shards):
+                    if j != i:
+                        writer.writerows(other)
+            result.append(shard_refs)
+
+        logging.getLogger().debug("Comparator input ({} rows) split into {} shards".format(len(rows), len(result)))
+        return result
+
+    def _run_shards(self, **kwargs):
+        '''
+        Execute one comparator process per shard concurrently and concatenate their outputs (in the order of shards)
+        into the output file. Each shard is appended as soon as it (and all the previous shards) are finished,
+        so the output is sorted by tested files if the outputs of the shards are.
+        '''
+        shards = self._prepare_shards()
+        processes = []
+        taskset = shutil.which('taskset')
+        for i, shard in enumerate(shards):
+            cpus = self._get_cpu_affinity(i, len(shards))
+            command = [self.exec] + self.get_args(shard)
+            if cpus and taskset:  # pinned before exec, so all threads of the comparator inherit the affinity
+                command = [taskset, '-c', ','.join(map(str, sorted(cpus)))] + command
+            stderr = open("{}/stderr-{}.log".format(self.files.get_shards_dir(), i), 'wb')
+            process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=stderr, **kwargs)
+            if cpus and not taskset:
+                try:
+                    os.sched_setaffinity(process.pid, cpus)  # preexec_fn is not safe (we may run in a thread)
+                except OSError:
+                    pass  # the process may have finished already
+            processes.append((process, stderr))
+
+        success = True
+        header_written = False
+        with open(self.get_output_file(), 'w', encoding="utf8", newline='') as fout:
+            for i, (process, stderr) in enumerate(processes):
+                process.wait()
+                stderr.close()
+                if not success:
+                    continue
+                if process.returncode != 0:
+                    with open(stderr.name, 'r', encoding="utf8", errors='replace') as fp:
+                        logging.getLogger().error("The comparator of shard {} failed.\n{}".format(i, fp.read()))
+                    success = False
+                    for other, _ in processes[i + 1:]:
+                        other.terminate()
+                    continue
+
+                with open(shards[i]['output'], 'r', encoding="utf8", newline='') as fin:
+                    header = fin.readline()  # all shards have the same header, it is written only once
+                    if header and not header_written:
+                        fout.write(header)
+                        header_written = True
+                    shutil.copyfileobj(fin, fout)
+                fout.flush()
+
+        if success:
+            shutil.rmtree(self.files.get_shards_dir())
+        return success
+
     def run(self, **kwargs):
         '''
-        Execute the comparator.
+        Execute the comparator (multiple processes on partitions of the manifest if sharding is configured).
         '''
+        if self.get_shard_count() > 1:
+            return self._run_shards(**kwargs)
+
         res = subprocess.run([self.exec] + self.get_args(), capture_output=True, **kwargs)
         if res.returncode != 0:
             logging.getLogger().error("The comparator failed.\n" + res.stderr.decode('utf8'))
             return False
         return True
+
+
+# Native engine workers (module-level functions, so they can be executed in a process pool)
+
+_worker_data = None  # shared data of the current worker process (set by the pool initializer)
+
+
+def _fingerprint_worker(args):
+    file, params = args
+    with open(file, 'rb') as fp:
+        size = len(fp.read())
+    return size, fingerprint_file(file, *params)
+
+
+def _init_compare_worker(data):
+    global _worker_data
+    _worker_data = dict(data)
+    _worker_data['index'] = None
+    if data['index_file'] is not None:
+        _worker_data['index'] = FingerprintIndex(data['index_file'], *data['params'], read_only=True)
+
+
+def _compare_worker(shard):
+    '''
+    Compare tested files (indices to the working files list) with all other files, return output rows.
+    '''
+    data = _worker_data
+    files = data['files']  # list of (file_id, solution_id, author_id)
+    inverted = data['inverted']  # hash -> list of (working file index, start, end)
+    result = []
+    for tested in shard:
+        file_id1, solution_id1, author_id1 = files[tested]
+        fingerprints = data['fingerprints'][tested]
+        archived = data['index'].find_matches([fp[0] for fp in fingerprints]) if data['index'] else {}
+
+        matches = {}  # file_id2 -> [solution_id2, author_id2, list of matched pairs]
+        for hash, o1, e1 in fingerprints:
+            for other, o2, e2 in inverted.get(hash, []):
+                file_id2, solution_id2, author_id2 = files[other]
+                if other != tested and author_id2 != author_id1:
+                    matches.setdefault(file_id2, [solution_id2, author_id2, []])[2].append((o1, e1, o2, e2))
+            for file_id2, solution_id2, author_id2, o2, e2 in archived.get(hash, []):
+                if author_id2 != author_id1 and solution_id2 not in data['working_solutions']:
+                    matches.setdefault(file_id2, [solution_id2, author_id2, []])[2].append((o1, e1, o2, e2))
+
+        # merge matched k-grams into fragments and compute similarity for each author
+        authors = {}  # author_id2 -> list of (file_id2, solution_id2, fragments)
+        for file_id2, (solution_id2, author_id2, pairs) in matches.items():
+            fragments = [f for f in merge_fragments(pairs, data['max_gap']) if f[1] - f[0] >= data['min_length']]
+            if fragments:
+                authors.setdefault(author_id2, []).append((file_id2, solution_id2, fragments))
+
+        size = data['sizes'][tested]
+        for author_id2 in sorted(authors):
+            covered = coverage([(f[0], f[1]) for _, _, fragments in authors[author_id2] for f in fragments])
+            similarity = 100.0 * covered / size if size > 0 else 0.0
+            if similarity < data['min_percentage']:
+                continue
+            for file_id2, solution_id2, fragments in sorted(authors[author_id2]):
+                for o1, e1, o2, e2 in fragments:
+                    result.append([author_id2, round(similarity, 2), file_id1, solution_id1, o1, e1 - o1,
+                                   file_id2, solution_id2, o2, e2 - o2])
+    return result
+
+
+class NativeComparator(Comparator):
+    '''
+    Built-in comparator engine. Files are tokenized and fingerprinted by winnowing, matches are looked up
+    in an inverted index of the working batch and in the persistent fingerprint index of the archive.
+    The output CSV has the same columns as the output of the external tool (and it is sorted by tested files).
+    '''
+
+    def __init__(self, config, files, exercise):
+        super().__init__(config, files, exercise)
+        native = dict(config.get('native', {}))
+        native.update(config.get('exercise_args', {}).get(exercise, {}).get('native', {}))
+        self.workers = native.get('workers', os.cpu_count() or 1)
+        self.shard_size = native.get('shard_size', 50)
+        self.min_percentage = native.get('min_percentage', 0)
+        self.min_length = native.get('min_length', 0)  # min. length of a fragment in bytes (in the tested file)
+        self.max_gap = native.get('max_gap', 0)  # max. gap in bytes between matches joined into one fragment
+        self.output_sorted = True
+        self.header = None
+        self.rows = None
+
+    def _uses_fingerprint_index(self):
+        return True
+
+    def get_args(self):
+        '''
+        The native engine has no command line, its parameters are reported instead (stored with the batch).
+        '''
+        k, window, normalize = self._get_fingerprint_params()
+        return ['k={}'.format(k), 'window={}'.format(window), 'normalize={}'.format(normalize),
+                'min_percentage={}'.format(self.min_percentage), 'min_length={}'.format(self.min_length)]
+
+    def prepare(self, header, rows):
+        '''
+        Remember the working batch, make sure the archive fingerprint index is up to date.
+        '''
+        self.header = header
+        self.rows = rows
+        self.update_archive_index()
+
+    def run(self, **kwargs):
+        '''
+        Execute the comparison in a pool of processes (tested files are split into shards).
+        '''
+        wd = self.files.get_working_dir()
+        files = [(row['file_id'], row['solution_id'], row['author_id']) for row in self.rows]
+        archive = None
+        if os.path.exists(self.files.get_archive_manifest_file()):
+            archive = self.files.get_archive_index()
+
+        tested = [i for i, row in enumerate(self.rows)
+                  if archive is None or not self.is_delta_enabled() or not archive.has_solution(row['solution_id'])]
+        params = self._get_fingerprint_params()
+
+        fingerprinted = self._get_fingerprints([wd + '/' + row['path'] for row in self.rows], self.workers,
+                                               self.shard_size)
+
+        inverted = {}
+        for i, (_, fingerprints) in enumerate(fingerprinted):
+            for hash, start, end in fingerprints:
+                inverted.setdefault(hash, []).append((i, start, end))
+
+        data = {
+            'files': files,
+            'sizes': [size for size, _ in fingerprinted],
+            'fingerprints': [fingerprints for _, fingerprints in fingerprinted],
+            'inverted': inverted,
+            'working_solutions': dict.fromkeys([row['solution_id'] for row in self.rows]),
+            'index_file': self.files.get_fingerprint_index_file() if archive is not None else None,
+            'params': params,
+            'min_percentage': self.min_percentage,
+            'min_length': self.min_length,
+            'max_gap': self.max_gap,
+        }
+        shards = [tested[i:i + self.shard_size] for i in range(0, len(tested), self.shard_size)]
+        columns = self.get_output_columns()
+        with open(self.get_output_file(), 'w', encoding="utf8", newline='') as fout:
+            writer = csv.writer(fout, **self.get_output_csv_params())
+            writer.writerow([columns[key] for key in OUTPUT_KEYS])
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_compare_worker,
+                                     initargs=(data,)) as executor:
+                for rows in executor.map(_compare_worker, shards):
+                    writer.writerows(rows)
+                    fout.flush()  # the output may be consumed while it is being written
+
+        logging.getLogger().debug("Native comparator tested {} of {} files in {} shards".format(
+            len(tested), len(files), len(shards)))
+        return True
+
+
+def create_comparator(config, files, exercise):
+    '''
+    Create the comparator selected by the `engine` option of the comparator config ('external' or 'native').
+    '''
+    engine = config.get('engine', 'external')
+    if engine == 'native':
+        return NativeComparator(config, files, exercise)
+    if engine == 'external':
+        return Comparator(config, files, exercise)
+    raise RuntimeError("Unknown comparator engine '{}'.".format(engine))
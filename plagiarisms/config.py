@@ -27,11 +27,18 @@ def _fix_config_path(path, base):
     return path
 
 
+def find_config_file(cfg_file):
+    '''
+    Return path to the configuration file (./config.yaml is used if no file is given).
+    '''
+    return _find_file(cfg_file, './config.yaml')
+
+
 def load_config(cfg_file):
     '''
     Find and load configuration yaml file and parse it.
     '''
-    cfg_file = _find_file(cfg_file, './config.yaml')
+    cfg_file = find_config_file(cfg_file)
     with open(cfg_file, "r", encoding="utf8") as fp:
         yaml = YAML(typ="safe")
         config = yaml.load(fp)
@@ -41,6 +48,13 @@ def load_config(cfg_file):
     for dir in config['dirs']:
         config['dirs'][dir] = config['dirs'][dir].format(base)
     config['downloader']['exec'] = config['downloader']['exec'].format(base)
-    config['comparator']['exec'] = config['comparator']['exec'].format(base)
+    # the caches must outlive the working dir (which is the config dir of the downloader), so they get absolute paths
+    abs_base = os.path.dirname(os.path.abspath(cfg_file))
+    for section, key in [('user_cache', 'file'), ('response_cache', 'dir')]:
+        if (config['downloader'].get(section) or {}).get(key):
+            path = config['downloader'][section][key].format(abs_base)
+            config['downloader'][section][key] = _fix_config_path(path, abs_base)
+    if 'exec' in config['comparator']:  # the native engine does not need an executable
+        config['comparator']['exec'] = config['comparator']['exec'].format(base)
 
     return config
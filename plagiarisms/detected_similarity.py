@@ -1,6 +1,12 @@
+import os
 import csv
+import heapq
 import logging
+import tempfile
+from array import array
 import recodex_api
+import metrics
+from uploader import SimilarityUploader
 
 
 class DetectedSimilarity:
@@ -9,17 +15,38 @@ class DetectedSimilarity:
     These data are uploaded together in a single add_similarities API call.
     '''
 
-    def __init__(self, solution_id, file_id, author_id, similarity):
+    def __init__(self, solution_id, file_id, author_id, similarity, merge_gap=None):
         self.solution_id = solution_id
         self.file_id = file_id
         self.author_id = author_id
         self.similarity = similarity
-        self.files = {}
+        self.merge_gap = merge_gap  # max. gap between fragments that are merged into one (None = no merging)
+        self.files = {}  # solution ID -> file ID -> flat array of fragments (o1, l1, o2, l2, o1, l1, ...)
 
     def add_file(self, solution_id, file_id, o1, l1, o2, l2):
         self.files[solution_id] = self.files.get(solution_id, {})
-        self.files[solution_id][file_id] = self.files[solution_id].get(file_id, [])
-        self.files[solution_id][file_id].append([{'o': o1, 'l': l1}, {'o': o2, 'l': l2}])
+        fragments = self.files[solution_id].get(file_id)
+        if fragments is None:
+            fragments = self.files[solution_id][file_id] = array('q')
+
+        if self.merge_gap is not None and fragments:
+            # the new fragment continues (or overlaps) the last one in both files -> extend the last one
+            lo1, ll1, lo2, ll2 = fragments[-4:]
+            if lo1 <= o1 <= lo1 + ll1 + self.merge_gap and lo2 <= o2 <= lo2 + ll2 + self.merge_gap:
+                fragments[-3] = max(lo1 + ll1, o1 + l1) - lo1
+                fragments[-1] = max(lo2 + ll2, o2 + l2) - lo2
+                metrics.increment('fragments_merged')
+                return
+
+        fragments.extend((o1, l1, o2, l2))
+
+    def get_fragments(self, solution_id, file_id):
+        '''
+        Return fragments of given file in the upload format (list of pairs of offset-length dicts).
+        '''
+        fragments = self.files[solution_id][file_id]
+        return [[{'o': fragments[i], 'l': fragments[i + 1]}, {'o': fragments[i + 2], 'l': fragments[i + 3]}]
+                for i in range(0, len(fragments), 4)]
 
     def upload(self, batch_id):
         # assemble the upload record from internal values
@@ -29,7 +56,7 @@ class DetectedSimilarity:
                 files.append({
                     'solutionId': solution_id,
                     'solutionFileId': file_id,
-                    'fragments': self.files[solution_id][file_id]
+                    'fragments': self.get_fragments(solution_id, file_id)
                 })
 
         return recodex_api.add_similarity(batch_id, self.solution_id, {
@@ -75,13 +102,158 @@ def load_similarities_from_csv(file_name, columns, **kwargs):
     return result
 
 
-def save_similarities(tool_name, tool_params, similarities, assignments):
+def _sort_csv_rows(reader, key_index, chunk_rows, temp_dir):
+    '''
+    External sort of CSV rows (lists) by given key column. Rows are sorted in chunks that are saved
+    into temporary files which are merged afterwards. The sort is stable (rows with the same key keep their order).
+    Yields sorted rows, temporary files are removed once the generator is exhausted or closed.
+    '''
+    files = []
+    try:
+        while True:
+            chunk = []
+            for row in reader:
+                chunk.append(row)
+                if len(chunk) >= chunk_rows:
+                    break
+            if not chunk:
+                break
+
+            chunk.sort(key=lambda row: row[key_index])
+            fp = tempfile.TemporaryFile('w+', encoding="utf8", newline='', dir=temp_dir)
+            csv.writer(fp).writerows(chunk)
+            fp.seek(0)
+            files.append(fp)
+            if len(chunk) < chunk_rows:
+                break
+
+        yield from heapq.merge(*[csv.reader(fp) for fp in files], key=lambda row: row[key_index])
+    finally:
+        for fp in files:
+            fp.close()
+
+
+def prune_similarities(group, pruning):
+    '''
+    Select similarities of one tested file (list of DetectedSimilarity objects) that are worth uploading.
+    Pruning is a dict (loaded from config) with min_percentage (weaker similarities are dropped)
+    and top_k (only k most similar authors are kept).
+    '''
+    min_similarity = pruning.get('min_percentage', 0) / 100.0
+    result = [similarity for similarity in group if similarity.similarity >= min_similarity]
+    top_k = pruning.get('top_k')
+    if top_k is not None and len(result) > top_k:
+        result = sorted(result, key=lambda similarity: similarity.similarity, reverse=True)[:top_k]
+    return result
+
+
+def stream_similarities(lines, columns, presorted=False, sort_chunk_rows=1000000, temp_dir=None, pruning=None,
+                        **kwargs):
+    '''
+    Generator that parses comparatrix output (iterable of CSV lines) and yields DetectedSimilarity objects.
+    All similarities of one tested file are yielded together as soon as its group of rows is complete,
+    so the memory consumption is bounded by the largest group (not by the size of the output).
+    If the rows of each tested file are not contiguous (presorted is False), the rows are external-sorted first
+    (temporary files are created in temp_dir).
+    Weak similarities are pruned and adjacent fragments merged according to pruning config (see prune_similarities,
+    merge_gap is passed to DetectedSimilarity).
+    Remaining named arguments are passed down to the CSV reader (e.g., useful for setting a delimiter).
+    '''
+    pruning = pruning or {}
+    merge_gap = pruning.get('merge_gap')
+    count = 0
+    records = 0
+    pruned = 0
+
+    def flush(group):
+        nonlocal records, pruned
+        result = prune_similarities(list(group.values()), pruning)
+        records += len(result)
+        pruned += len(group) - len(result)
+        return result
+
+    reader = csv.reader(lines, **kwargs)
+    header = next(reader, [])
+    if not header:
+        return  # empty output (no header), nothing detected
+    idx = {key: header.index(columns[key]) for key in columns}
+    if not presorted:
+        reader = _sort_csv_rows(reader, idx['file_id1'], sort_chunk_rows, temp_dir)
+
+    current_file_id = None
+    group = {}  # author ID -> DetectedSimilarity (of the current tested file)
+    for row in reader:
+        count += 1
+        file_id = row[idx['file_id1']]  # first (tested) file
+        if file_id != current_file_id:
+            yield from flush(group)
+            current_file_id = file_id
+            group = {}
+
+        author_id = row[idx['author_id']]  # author of the second (similar) file
+        if author_id not in group:
+            group[author_id] = DetectedSimilarity(row[idx['solution_id1']], file_id, author_id,
+                                                  float(row[idx['similarity']]) / 100.0, merge_gap)
+
+        group[author_id].add_file(
+            row[idx['solution_id2']],
+            row[idx['file_id2']],
+            int(row[idx['offset1']]),
+            int(row[idx['length1']]),
+            int(row[idx['offset2']]),
+            int(row[idx['length2']])
+        )
+
+    yield from flush(group)
+
+    metrics.increment('rows_parsed', count)
+    metrics.increment('similarity_records', records)
+    metrics.increment('similarity_records_pruned', pruned)
+    logging.getLogger().debug("Comparator yielded {} matches, aggregated in {} similarity records ({} pruned)".format(
+        count, records, pruned))
+
+
+def stream_similarities_from_csv(file_name, columns, presorted=False, sort_chunk_rows=1000000, pruning=None,
+                                 **kwargs):
+    '''
+    Generator that loads given CSV file with comparatrix output and yields DetectedSimilarity objects
+    (see stream_similarities for details).
+    '''
+    with open(file_name, 'r', encoding="utf8", newline='') as f:
+        yield from stream_similarities(f, columns, presorted, sort_chunk_rows, os.path.dirname(file_name) or None,
+                                       pruning, **kwargs)
+
+
+def save_similarities(tool_name, tool_params, similarities, assignments, uploader=None, checkpoint=None):
     '''
     Save loaded similarities in one batch upload (return the batch ID).
-    Similarities arg holds a list of DetectedSimilarity objects loaded from CSV.
+    Similarities arg holds a list (or any iterable) of DetectedSimilarity objects loaded from CSV.
+    The batch is closed only after the uploader confirms all the records.
+    If a checkpoint is given, the progress is recorded there and a previously opened batch is continued
+    (records that were already uploaded are skipped).
     '''
-    batch_id = recodex_api.create_batch(tool_name, tool_params)
-    for similarity in similarities:
-        similarity.upload(batch_id)
-    recodex_api.close_batch(batch_id, assignments)
+    if uploader is None:
+        uploader = SimilarityUploader({})
+
+    batch_id = checkpoint.get('batch_id') if checkpoint else None
+    if batch_id is None:
+        batch_id = recodex_api.create_batch(tool_name, tool_params)
+        if checkpoint:
+            checkpoint.set('batch_id', batch_id)
+    else:
+        logging.getLogger().info("Continuing upload to batch {} ({} records already uploaded)".format(
+            batch_id, checkpoint.get('uploaded')))
+
+    if checkpoint:
+        try:
+            count = uploader.upload(batch_id, similarities, checkpoint.is_uploaded, checkpoint.mark_uploaded)
+        finally:
+            checkpoint.save()  # confirmed uploads must not be repeated when resumed (even if the upload failed)
+    else:
+        count = uploader.upload(batch_id, similarities)
+    logging.getLogger().debug("{} similarity records uploaded to batch {}".format(count, batch_id))
+
+    recodex_api.close_batch(batch_id, assignments)  # raises on failure (the upload is not marked as completed)
+    if checkpoint:
+        checkpoint.set('upload_completed', True)
     return batch_id
@@ -5,13 +5,19 @@
 # back to the ReCodEx. It relies on solution-downloader and recodex CLI tools.
 #
 
+import os
+import time
 import argparse
 import logging
-from config import load_config
-from detected_similarity import load_similarities_from_csv, save_similarities
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from config import load_config, find_config_file
+from detected_similarity import stream_similarities, stream_similarities_from_csv, save_similarities
 from downloader import Downloader
 from files import FilesManager
-from comparator import Comparator
+from comparator import create_comparator
+from uploader import SimilarityUploader
+from metrics import RunMetrics
+from checkpoint import Checkpoint
 
 
 def str_to_logging_level(level):
@@ -30,6 +36,8 @@ def setup_logger(logger_config, file_manager):
     Initialize logging based on the configuration. The logger typically writes output to console as well as to a file.
     '''
     logger = logging.getLogger()
+    for handler in logger.handlers:
+        handler.close()  # the logger may be set up repeatedly in one process (e.g., by a scheduler)
     logger.handlers.clear()
     logger.setLevel(logging.NOTSET)
 
@@ -37,7 +45,7 @@ def setup_logger(logger_config, file_manager):
     if console_level is not None:
         console_handler = logging.StreamHandler()
         console_handler.setLevel(console_level)
-        console_formatter = logging.Formatter("PDM (%(asctime)s): %(message)s")
+        console_formatter = logging.Formatter("PDM " + file_manager.exercise + " (%(asctime)s): %(message)s")
         console_handler.setFormatter(console_formatter)
         logger.addHandler(console_handler)
 
@@ -50,74 +58,284 @@ def setup_logger(logger_config, file_manager):
         logger.addHandler(file_handler)
 
 
-def process_results(comparator, assignments):
+def upload_similarities(comparator, uploader, similarities, assignments, checkpoint):
+    '''
+    Upload parsed similarities as a new batch and mark given assignments as checked by this batch.
+    The progress is recorded in the checkpoint (so the upload can be resumed).
+    '''
+    comparator_args = " ".join(comparator.get_args())
+    batch_id = save_similarities(comparator.get_name(), comparator_args,
+                                 similarities, assignments, uploader, checkpoint)
+    logging.getLogger().info("Similarities saved to ReCodEx as batch {}".format(batch_id))
+
+
+def process_results(comparator, uploader, assignments, checkpoint):
     '''
     Parse the comparator output, aggregate similarity records, and upload them
-    as a batch to ReCodEx.
+    as a batch to ReCodEx (using given uploader).
     The assignments are passed from the downloader and these assignments will
     be marked as checked by this batch.
     '''
     logging.getLogger().debug("Parsing comparator output {}".format(comparator.get_output_file()))
-    similarities = load_similarities_from_csv(
-        comparator.get_output_file(), comparator.get_output_columns(), **comparator.get_output_csv_params())
-    comparator_args = " ".join(comparator.get_args())
-    batch_id = save_similarities(comparator.get_name(), comparator_args,
-                                 similarities, assignments)
-    logging.getLogger().info("Similarities saved to ReCodEx as batch {}".format(batch_id))
+    similarities = stream_similarities_from_csv(
+        comparator.get_output_file(), comparator.get_output_columns(), comparator.is_output_sorted(),
+        comparator.get_output_sort_chunk(), comparator.get_output_pruning(), **comparator.get_output_csv_params())
+    upload_similarities(comparator, uploader, similarities, assignments, checkpoint)
 
 
-if __name__ == "__main__":
-    # Process program arguments...
-    parser = argparse.ArgumentParser()
-    parser.add_argument("exercise", type=str, help="Identifier of the exercise.")
-    parser.add_argument("--config", type=str,
-                        help="Path to yaml file with simulation configuration (./config.yaml is default).")
-    args = parser.parse_args()
+def run_pipelined(comparator, uploader, assignments, checkpoint):
+    '''
+    Run the comparator, parse its output, and upload the similarities concurrently.
+    Each similarity group is uploaded as soon as the comparator finishes writing its rows.
+    '''
+    if not comparator.is_output_sorted():
+        logging.getLogger().warning("Comparator output is not sorted, parsing has to wait for the comparator.")
 
-    # Load configuration
-    config = load_config(args.config)
-    if args.exercise not in config.get('exercises', {}):
-        print("Invalid exercise identifier '{}'. Config holds exercises '{}'.".format(
-            args.exercise, "', '".join(config['exercises'].keys())))
-    exercise_id = config['exercises'][args.exercise]
+    similarities = stream_similarities(
+        comparator.run_streaming(), comparator.get_output_columns(), comparator.is_output_sorted(),
+        comparator.get_output_sort_chunk(), os.path.dirname(comparator.get_output_file()),
+        comparator.get_output_pruning(), **comparator.get_output_csv_params())
+    upload_similarities(comparator, uploader, similarities, assignments, checkpoint)
 
-    # Initialization
-    print("Initialization for evaluation of exercise {} ({}) ...".format(args.exercise, exercise_id))
-    file_manager = FilesManager(config['dirs'], args.exercise)
-    if file_manager.working_dir_exists():
-        print("Working directory {} exists, probably since the last execution failed. Please, remove the working directory safely before executing the detection manager.".format(
-            file_manager.get_working_dir()))
-        exit(1)
+
+def save_metrics(metrics, file_manager):
+    '''
+    Export collected metrics of the run (failures are only logged, metrics must not break the detection).
+    '''
+    try:
+        metrics.write_json(file_manager.get_metrics_file())
+        if file_manager.get_prometheus_file() is not None:
+            metrics.write_prometheus(file_manager.get_prometheus_file())
+    except Exception as e:
+        logging.getLogger().error("Unable to save metrics: {}".format(e))
+
+
+class DetectionContext:
+    '''
+    Components of one exercise that can be reused by subsequent detection runs (in daemon mode).
+    They keep the archive manifest index and the fingerprint index open.
+    '''
+
+    def __init__(self, config, exercise):
+        self.file_manager = FilesManager(config['dirs'], exercise)
+        self.comparator = create_comparator(config.get("comparator", {}), self.file_manager, exercise)
+
+
+def run_detection(config, exercise, resume=False, context=None, prechecked=False):
+    '''
+    Run the whole detection process (download, compare, upload, and merge) for one exercise.
+    Each exercise has its own working directory, so multiple exercises may be processed concurrently.
+    Progress is checkpointed after each stage; if resume is true, a failed run left in the working dir is continued.
+    The context (DetectionContext) may be kept from previous runs (resident process, the downloader keeps its caches
+    in memory as well). If prechecked is true, the pre-check
+    has been done already (its result is in the working dir) and it found new solutions.
+    Returns an exit code (0 on success).
+    '''
+    exercise_id = config['exercises'][exercise]
+    print("Initialization for evaluation of exercise {} ({}) ...".format(exercise, exercise_id))
+    resident = context is not None
+    context = context or DetectionContext(config, exercise)
+    file_manager = context.file_manager
+    checkpoint = Checkpoint(file_manager.get_checkpoint_file())
+    if file_manager.working_dir_exists() and not prechecked:
+        if not resume:
+            print("Working directory {} exists, probably since the last execution failed. Please, use --resume or remove the working directory safely before executing the detection manager.".format(
+                file_manager.get_working_dir()))
+            return 1
+        if not checkpoint.exists():
+            print("Working directory {} has no checkpoint, the run cannot be resumed. Please, remove the working directory safely before executing the detection manager.".format(
+                file_manager.get_working_dir()))
+            return 1
 
     setup_logger(config.get('logger', {}), file_manager)
 
-    downloader = Downloader(config, file_manager, args.exercise)
-    comparator = Comparator(config.get("comparator", {}), file_manager, args.exercise)
+    downloader = Downloader(config, file_manager, exercise, resident)
+    comparator = context.comparator
+    uploader = SimilarityUploader(config.get("uploader", {}))
 
     # Download, compare, upload ...
+    metrics = RunMetrics(exercise)
     try:
         file_manager.prepare_working_dir()
 
-        logging.getLogger().info("Starting the download process...")
-        downloader.run()
+        if checkpoint.get('downloaded'):
+            logging.getLogger().info("Resuming, using solutions downloaded by the previous run...")
+            downloader.load()
+        else:
+            found = True
+            if downloader.is_precheck_enabled() and not prechecked:
+                logging.getLogger().info("Checking for new solutions...")
+                with metrics.stage('precheck'):
+                    found = downloader.precheck()
+            if found:
+                logging.getLogger().info("Starting the download process...")
+                with metrics.stage('download'):
+                    downloader.run(comparator.prefetch)  # the comparator may start working on downloaded files
+                checkpoint.set('downloaded', True)
 
         if downloader.has_new_solutions():
-            logging.getLogger().info("Starting the external comparator...")
-            logging.getLogger().debug(' '.join(comparator.get_args()))
-            comparator.run()
+            with metrics.stage('prepare'):
+                comparator.prepare(downloader.get_working_header(), downloader.get_working_rows())
 
-            logging.getLogger().info("Uploading results to ReCodEx...")
-            process_results(comparator, downloader.get_assignments())
+            if not checkpoint.get('compared') and checkpoint.get('batch_id') is not None:
+                logging.getLogger().warning("Comparator output will be re-created, batch {} is abandoned.".format(
+                    checkpoint.get('batch_id')))
+                checkpoint.reset_upload()
+
+            if checkpoint.get('upload_completed'):
+                logging.getLogger().info("Resuming, results have been uploaded already.")
+            elif comparator.is_pipelined() and not checkpoint.get('compared'):
+                logging.getLogger().info("Starting the comparator, uploading results to ReCodEx concurrently...")
+                logging.getLogger().debug(' '.join(comparator.get_args()))
+                with metrics.stage('compare_upload'):
+                    run_pipelined(comparator, uploader, downloader.get_assignments(), checkpoint)
+                checkpoint.set('compared', True)
+            else:
+                if checkpoint.get('compared'):
+                    logging.getLogger().info("Resuming, using output of the previous comparator run...")
+                else:
+                    logging.getLogger().info("Starting the comparator...")
+                    logging.getLogger().debug(' '.join(comparator.get_args()))
+                    with metrics.stage('compare'):
+                        if not comparator.run():
+                            raise RuntimeError("The comparator failed.")
+                    checkpoint.set('compared', True)
+
+                logging.getLogger().info("Uploading results to ReCodEx...")
+                with metrics.stage('upload'):
+                    process_results(comparator, uploader, downloader.get_assignments(), checkpoint)
 
             logging.getLogger().info("Updating solution archive...")
-            downloader.merge_new_solutions()
-            file_manager.update_solution_dirs()
+            with metrics.stage('merge'):
+                downloader.merge_new_solutions()  # idempotent, solutions already in the archive are skipped
+                comparator.update_archive_index(downloader.get_working_rows())
+                checkpoint.set('merged', True)
+                downloader.update_watermark()
+                file_manager.update_solution_dirs()  # the working dir (and the checkpoint) is moved away
         else:
             logging.getLogger().info("No new solutions detected.")
+            downloader.update_watermark()
             file_manager.clear_working_dir()
 
+        metrics.success = True
+
     except Exception as e:
         logging.getLogger().exception(e)
-        exit(2)
+        return 2
+
+    finally:
+        comparator.close()  # the prefetch processes must not outlive the run (the context may be kept)
+        save_metrics(metrics, file_manager)
 
     logging.getLogger().info("Detection process completed.")
+    return 0
+
+
+def run_all_detections(config, workers, resume=False):
+    '''
+    Run detection of all configured exercises in a pool of processes (at most `workers` run concurrently).
+    Returns an exit code (0 if all exercises succeeded, otherwise the highest code returned).
+    '''
+    result = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_detection, config, exercise, resume): exercise for exercise in config['exercises']}
+        for future in as_completed(futures):
+            try:
+                code = future.result()
+            except Exception as e:
+                print("Detection of exercise {} crashed: {}".format(futures[future], e))
+                code = 2
+            if code != 0:
+                print("Detection of exercise {} failed (exit code {}).".format(futures[future], code))
+            result = max(result, code)
+    return result
+
+
+def poll_detection(config, exercise, context):
+    '''
+    One daemon cycle of an exercise -- list its solutions (pre-check) and run the detection only if there are new ones.
+    A failed run (left in the working dir) is resumed. Returns an exit code (0 on success or if there is nothing new).
+    '''
+    file_manager = context.file_manager
+    if file_manager.working_dir_exists():
+        return run_detection(config, exercise, True, context)
+
+    setup_logger(dict(config.get('logger', {}), file_level=None), file_manager)  # no log files for mere polls
+    downloader = Downloader(config, file_manager, exercise, resident=True)
+    file_manager.prepare_working_dir()
+    try:
+        found = downloader.precheck()
+    except Exception:
+        file_manager.clear_working_dir()
+        raise
+
+    if not found:
+        downloader.update_watermark()
+        file_manager.clear_working_dir()
+        return 0
+    return run_detection(config, exercise, False, context, prechecked=True)
+
+
+def run_daemon(config_file):
+    '''
+    Stay resident and poll all configured exercises periodically (daemon.poll_interval seconds between cycles).
+    The detection runs only for exercises with new solutions, components of the exercises (with their indexes)
+    are kept between the cycles. The config file is reloaded (and the components re-created) when it is modified.
+    '''
+    config_file = find_config_file(config_file)
+    config = None
+    config_mtime = None
+    contexts = {}
+    while True:
+        mtime = os.path.getmtime(config_file)
+        if mtime != config_mtime:
+            config = load_config(config_file)
+            config_mtime = mtime
+            contexts = {}
+            print("Configuration {} loaded.".format(config_file))
+
+        for exercise in config['exercises']:
+            try:
+                if exercise not in contexts:
+                    contexts[exercise] = DetectionContext(config, exercise)
+                code = poll_detection(config, exercise, contexts[exercise])
+                if code != 0:
+                    print("Detection of exercise {} failed (exit code {}).".format(exercise, code))
+            except Exception as e:
+                print("Detection of exercise {} crashed: {}".format(exercise, e))
+                contexts.pop(exercise, None)  # start with fresh components next time
+
+        time.sleep(config.get('daemon', {}).get('poll_interval', 300))
+
+
+if __name__ == "__main__":
+    # Process program arguments...
+    parser = argparse.ArgumentParser()
+    parser.add_argument("exercise", type=str, nargs='?', help="Identifier of the exercise.")
+    parser.add_argument("--config", type=str,
+                        help="Path to yaml file with simulation configuration (./config.yaml is default).")
+    parser.add_argument("--all", default=False, action="store_true",
+                        help="Process all exercises from the config concurrently (exercise argument is ignored).")
+    parser.add_argument("--resume", default=False, action="store_true",
+                        help="Continue a failed run from its checkpoint (reusing downloads, output, and uploads).")
+    parser.add_argument("--daemon", default=False, action="store_true",
+                        help="Stay resident and periodically run detection of all exercises that have new solutions.")
+    parser.add_argument("--jobs", type=int,
+                        help="Max. number of exercises processed concurrently in --all mode (overrides the config).")
+    args = parser.parse_args()
+
+    if args.daemon:
+        run_daemon(args.config)
+
+    # Load configuration
+    config = load_config(args.config)
+    if args.all:
+        workers = args.jobs or config.get('scheduler', {}).get('workers', 1)
+        exit(run_all_detections(config, workers, args.resume))
+
+    if args.exercise not in config.get('exercises', {}):
+        print("Invalid exercise identifier '{}'. Config holds exercises '{}'.".format(
+            args.exercise, "', '".join(config['exercises'].keys())))
+        exit(1)
+
+    exit(run_detection(config, args.exercise, args.resume))
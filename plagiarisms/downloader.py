@@ -1,20 +1,50 @@
 import os
-import shutil
+import sys
 import csv
+import json
+import importlib.util
 from ruamel.yaml import YAML
 import subprocess
 import logging
+import metrics
 
 CONFIG_FILE = 'config.yaml'  # generated for the downloader tool
+PRECHECK_CONFIG_FILE = 'precheck.yaml'  # generated for the pre-check (listing solutions without downloading them)
+PRECHECK_MANIFEST_FILE = 'precheck.csv'  # solutions listed by the pre-check
+PRECHECK_MANIFEST = {  # columns of the pre-check manifest
+    'solution_id': 'solution.id',
+    'created_at': 'solution.createdAt',
+    'assignment_id': 'assignment.id',
+}
 
+_library = None  # download.py of the solution-downloader imported as a module (library mode)
+_library_user_cache = {}  # users loaded by the library (shared by all runs in this process)
 
-def get_csv_header(file):
+
+def import_library(script):
     '''
-    Return field names of given CSV file.
+    Import the downloader script (download.py) as a module. The solution-downloader has its own recodex_api module
+    (which clashes with ours), so our module is temporarily removed from sys.modules while the downloader modules
+    are imported. The imported modules keep references to their own recodex_api module.
     '''
-    with open(file, 'r', encoding="utf8") as f:
-        reader = csv.DictReader(f)
-        return list(reader.fieldnames)
+    global _library
+    if _library is not None:
+        return _library
+
+    script_dir = os.path.dirname(os.path.abspath(script))
+    own_modules = {name: sys.modules.pop(name) for name in ['recodex_api'] if name in sys.modules}
+    sys.path.insert(0, script_dir)
+    try:
+        spec = importlib.util.spec_from_file_location('solution_downloader', script)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(script_dir)
+        sys.modules.pop('recodex_api', None)  # downloader's module, referenced by the imported modules only
+        sys.modules.update(own_modules)
+
+    _library = module
+    return _library
 
 
 def load_manifest_solutions(manifest_file, solution_id_col='solution_id'):
@@ -38,33 +68,159 @@ class Downloader:
     That includes config creation, download verification, and merging new downloads with archive.
     '''
 
-    def __init__(self, config, files, exercise):
+    def __init__(self, config, files, exercise, resident=False):
         '''
         Initialize this component by injecting dependencies.
+        In a resident process (daemon), the pre-check is always executed as a library and the loaded groups,
+        assignments (for daemon.cache_ttl seconds), and users are kept in memory between the runs.
         '''
         self.config = config
         self.files = files
         self.exercise = exercise
+        self.resident = resident
+        self.working_rows = None  # rows of the working manifest (loaded only once)
+        self.working_header = []
 
     def _get_config_file(self):
         return self.files.get_working_dir() + '/' + CONFIG_FILE
 
+    def _get_precheck_config_file(self):
+        return self.files.get_working_dir() + '/' + PRECHECK_CONFIG_FILE
+
+    def _get_precheck_manifest_file(self):
+        return self.files.get_working_dir() + '/' + PRECHECK_MANIFEST_FILE
+
+    def _is_watermark_enabled(self):
+        return self.config['downloader'].get('watermark', {}).get('enabled', False)
+
+    def is_precheck_enabled(self):
+        '''
+        True if the solutions are listed (without downloading) first. The watermark needs the pre-check
+        (the createdAt values are not in the main manifest).
+        '''
+        return self.config['downloader'].get('precheck', False) or self._is_watermark_enabled()
+
+    def _load_watermark(self):
+        '''
+        Return persisted createdAt of the newest solution seen so far (None if there is none).
+        '''
+        if not os.path.exists(self.files.get_watermark_file()):
+            return None
+        with open(self.files.get_watermark_file(), 'r', encoding="utf8") as fp:
+            return json.load(fp).get('createdAt')
+
+    def _get_solutions_filter(self):
+        '''
+        Return the solutions filter for the downloader tool. If the watermark is enabled, createdAt condition
+        is set to the watermark minus configured margin (the margin covers solutions that become visible late).
+        '''
+        filter = dict(self.config.get('solutions', {}))
+        watermark = self._load_watermark() if self._is_watermark_enabled() else None
+        if watermark is not None:
+            margin = self.config['downloader']['watermark'].get('margin', 86400)
+            filter['createdAt'] = max(watermark - margin, filter.get('createdAt', 0))
+        return filter
+
+    def _write_config(self, file, new_config):
+        with open(file, 'w') as fp:
+            yaml = YAML(typ="safe")
+            yaml.dump(new_config, fp)
+
     def _prepare_config(self):
         '''
-        Creates a yaml config file for the downloader (mostly copying relevant
-        parts of the given config). The solutions_created_at is timestamp used
-        to filter solutions (only newer solutions are downloaded).
-        The file is saved to save_as path.
+        Creates a config for the downloader (mostly copying relevant
+        parts of the given config). The createdAt filter of solutions is set by the watermark
+        (if enabled), so only newer solutions are downloaded.
         '''
         new_config = {key: self.config[key] for key in
-                      ['exercises', 'groups', 'manifest', 'solutions']}
+                      ['exercises', 'groups', 'manifest']}
+        new_config['solutions'] = self._get_solutions_filter()
         new_config['path'] = ['solution.id']
         new_config['manifest']['solution_id'] = 'solution.id'
         new_config['manifest']['assignment_id'] = 'assignment.id'
+        self._copy_api_config(new_config)
+        return new_config
 
-        with open(self._get_config_file(), 'w') as fp:
-            yaml = YAML(typ="safe")
-            yaml.dump(new_config, fp)
+    def _copy_api_config(self, new_config):
+        '''
+        Copy settings of the API access (backend and caches) into the config, so the pre-check and the download
+        read the same sources.
+        '''
+        for key in ['backend', 'user_cache', 'response_cache']:
+            if self.config['downloader'].get(key):
+                new_config[key] = self.config['downloader'][key]
+
+    def is_library_mode(self):
+        '''
+        True if the downloader is imported and executed in this process (otherwise a python process is spawned).
+        '''
+        return self.config['downloader'].get('mode', 'process') == 'library'
+
+    def _run_tool(self, config_file, new_config, dest_dir, manifest_file, per_file, on_solution=None,
+                  library_mode=False):
+        '''
+        Execute the downloader with given config (dict) either in a separate process (the config is saved to
+        config_file) or in-process as a library (if configured or library_mode is set). In library mode,
+        on_solution(rows) is invoked with manifest rows of each solution right after it is downloaded.
+        '''
+        jobs = self.config['downloader'].get('jobs', 1)
+        cache_ttl = self.config.get('daemon', {}).get('cache_ttl', 3600) if self.resident else 0
+        rate_limit = self.config['downloader'].get('rate_limit')
+        stream_zip = self.config['downloader'].get('stream_zip', False)
+        zip_memory_limit = self.config['downloader'].get('zip_memory_limit')
+        if self.is_library_mode() or library_mode:
+            library = import_library(self.config['downloader']['exec'])
+            library.recodex_api.set_rate_limit(rate_limit)
+            library.recodex_api.set_zip_streaming(stream_zip, zip_memory_limit)
+            solutions = library.download_solutions(new_config, self.exercise, dest_dir, manifest_file, per_file,
+                                                   self.files.get_working_dir(), _library_user_cache,
+                                                   logging.getLogger().debug, jobs, cache_ttl=cache_ttl)
+            for _, rows in solutions:
+                if on_solution is not None:
+                    on_solution(rows)
+            return
+
+        self._write_config(config_file, new_config)
+        args = [self.config['downloader']['python'], self.config['downloader']['exec'], '--config', config_file]
+        if dest_dir:
+            args += ['--dest-dir', dest_dir]
+        args += ['--manifest', manifest_file]
+        if per_file:
+            args.append('--manifest-per-file')
+        args += ['--jobs', str(jobs)]
+        if rate_limit:
+            args += ['--rate-limit', str(rate_limit)]
+        if stream_zip:
+            args.append('--stream-zip')
+            if zip_memory_limit:
+                args += ['--zip-memory-limit', str(zip_memory_limit)]
+        res = subprocess.run(args + [self.exercise], capture_output=True)
+        if res.returncode != 0:
+            logging.getLogger().error(res.stderr.decode('utf8'))
+            raise RuntimeError("The downloader tool failed.")
+
+    def _get_working_rows(self):
+        '''
+        Return rows (dicts) of the working manifest, the file is parsed only once.
+        '''
+        if self.working_rows is None:
+            self.working_rows = []
+            if os.path.exists(self.files.get_working_manifest_file()):
+                with open(self.files.get_working_manifest_file(), 'r', encoding="utf8") as fin:
+                    reader = csv.DictReader(fin)
+                    self.working_header = list(reader.fieldnames or [])
+                    self.working_rows = list(reader)
+        return self.working_rows
+
+    def get_working_header(self):
+        self._get_working_rows()
+        return self.working_header
+
+    def get_working_rows(self):
+        return self._get_working_rows()
+
+    def _get_working_solutions(self):
+        return dict.fromkeys([row['solution_id'] for row in self._get_working_rows()], True)
 
     def _verify_download(self):
         '''
@@ -76,32 +232,84 @@ class Downloader:
             raise Exception("Download failed -- manifest file {} does not exist".format(manifest_file))
 
         wd = self.files.get_working_dir()
-        solutions = load_manifest_solutions(manifest_file)
+        self.working_rows = None  # new download, new manifest
+        solutions = self._get_working_solutions()
+        metrics.increment('manifest_rows', len(self.working_rows))
+        metrics.increment('solutions_downloaded', len(solutions))
         for solution in solutions:
             path = wd + '/' + solution
             if not os.path.exists(path) or not os.path.isdir(path):
                 raise Exception("Solution {} does not have any downloaded files".format(solution))
 
-    def run(self):
+    def precheck(self):
         '''
-        Invoke the downloader tool. The config should have been prepared.
+        List solutions (IDs and createdAt only, nothing is downloaded) that pass the same filter as the download.
+        Returns True if there is a solution that is not in the archive yet (i.e., the download is needed).
         '''
-        self._prepare_config()
+        new_config = {key: self.config[key] for key in ['exercises', 'groups']}
+        new_config['solutions'] = self._get_solutions_filter()
+        new_config['path'] = ['solution.id']
+        new_config['manifest'] = PRECHECK_MANIFEST
+        self._copy_api_config(new_config)
+        self._run_tool(self._get_precheck_config_file(), new_config, None, self._get_precheck_manifest_file(), False,
+                       library_mode=self.resident)  # no process is spawned for each poll of a daemon
 
-        args = [
-            self.config['downloader']['python'],
-            self.config['downloader']['exec'],
-            '--config', self._get_config_file(),
-            '--dest-dir', self.files.get_working_dir(),
-            '--manifest', self.files.get_working_manifest_file(),
-            '--manifest-per-file',
-            self.exercise
-        ]
-        res = subprocess.run(args, capture_output=True)
-        if res.returncode != 0:
-            logging.getLogger().error(res.stderr.decode('utf8'))
-            raise RuntimeError("The downloader tool failed.")
+        solutions = load_manifest_solutions(self._get_precheck_manifest_file())
+        metrics.increment('precheck_solutions', len(solutions))
+        if not os.path.exists(self.files.get_archive_manifest_file()):
+            return len(solutions) > 0
+
+        archive = self.files.get_archive_index()
+        return any(not archive.has_solution(solution) for solution in solutions)
 
+    def update_watermark(self):
+        '''
+        Persist createdAt of the newest archived solution listed by the pre-check (if the watermark is enabled).
+        Should be called after the new solutions are merged into the archive. The watermark never advances past
+        a listed solution that is not in the archive (e.g., the download missed it), so it is not filtered out later.
+        '''
+        if not self._is_watermark_enabled() or not os.path.exists(self._get_precheck_manifest_file()) \
+                or not os.path.exists(self.files.get_archive_manifest_file()):
+            return
+
+        archive = self.files.get_archive_index()
+        archived = []
+        missing = None  # createdAt of the oldest listed solution which is not archived
+        with open(self._get_precheck_manifest_file(), 'r', encoding="utf8") as fin:
+            for row in csv.DictReader(fin):
+                if not row['created_at']:
+                    continue
+                created_at = int(float(row['created_at']))
+                if archive.has_solution(row['solution_id']):
+                    archived.append(created_at)
+                elif missing is None or created_at < missing:
+                    missing = created_at
+
+        if missing is not None:
+            logging.getLogger().warning("Some solutions listed by the pre-check were not archived.")
+        old_watermark = self._load_watermark()
+        watermark = max([created_at for created_at in archived if missing is None or created_at < missing],
+                        default=None)
+        if watermark is not None and (old_watermark is None or watermark > old_watermark):
+            tmp = self.files.get_watermark_file() + '.tmp'
+            with open(tmp, 'w', encoding="utf8") as fp:
+                json.dump({'createdAt': watermark}, fp)
+            os.replace(tmp, self.files.get_watermark_file())
+            logging.getLogger().debug("Download watermark set to {}".format(watermark))
+
+    def run(self, on_solution=None):
+        '''
+        Invoke the downloader tool. In library mode, on_solution(rows) is invoked for each downloaded solution
+        (with its manifest rows), so the solutions may be processed before the download is completed.
+        '''
+        self._run_tool(self._get_config_file(), self._prepare_config(), self.files.get_working_dir(),
+                       self.files.get_working_manifest_file(), True, on_solution)
+        self._verify_download()
+
+    def load(self):
+        '''
+        Use a batch that has already been downloaded into the working dir (when a run is resumed).
+        '''
         self._verify_download()
 
     def has_new_solutions(self):
@@ -109,8 +317,7 @@ class Downloader:
         Check whether a newly downloaded batch has some new solutions (compared to the last batch).
         '''
         last_solutions = load_manifest_solutions(self.files.get_last_manifest_file())
-        new_solutions = load_manifest_solutions(self.files.get_working_manifest_file())
-        for solution in new_solutions:
+        for solution in self._get_working_solutions():
             if not last_solutions.get(solution, False):
                 return True  # new solution was found
         return False
@@ -118,42 +325,34 @@ class Downloader:
     def merge_new_solutions(self):
         '''
         Add all new solutions from working dir to the archive. Manifests are merged as well
-        (new lines are appended to archive manifest).
+        (new lines are appended to archive manifest, membership is checked in the archive index).
+        Returns the list of appended manifest rows.
         '''
         if not os.path.exists(self.files.get_archive_manifest_file()):
-            return  # no archive manifest -> archive does not exist or is corrupted
-
-        archive_header = get_csv_header(self.files.get_archive_manifest_file())
-        archive_solutions = load_manifest_solutions(self.files.get_archive_manifest_file())
-        with open(self.files.get_working_manifest_file(), 'r', encoding="utf8") as fin:
-            reader = csv.DictReader(fin)
-
-            # Let's make sure the manifests are compatible (archive columns must be equal or subset of new manifest columns)
-            archive_header_idx = dict.fromkeys(archive_header)
-            for col in reader.fieldnames:
-                if col not in archive_header_idx:
-                    raise RuntimeError(
-                        "Cannot merge solutions, manifests do not have the same headers (column '{}' is missing).".format(col))
-
-            # newly found records will be added to the archive
-            with open(self.files.get_archive_manifest_file(), 'a', encoding="utf8") as fout:
-                writer = csv.DictWriter(fout, fieldnames=archive_header)
-                for row in reader:
-                    solution_id = row['solution_id']
-                    if not archive_solutions.get(solution_id, False):
-                        # a solutions is appended to the manifest and its dir is copied
-                        writer.writerow(row)
-                        if not os.path.exists(self.files.get_archive_dir() + '/' + solution_id):
-                            shutil.copytree(self.files.get_working_dir() + '/' + solution_id,
-                                            self.files.get_archive_dir() + '/' + solution_id)
+            return []  # no archive manifest -> archive does not exist or is corrupted
+
+        archive = self.files.get_archive_index()
+        rows = self._get_working_rows()
+
+        # Let's make sure the manifests are compatible (archive columns must be equal or subset of new manifest columns)
+        archive_header_idx = dict.fromkeys(archive.get_header())
+        for col in self.working_header:
+            if col not in archive_header_idx:
+                raise RuntimeError(
+                    "Cannot merge solutions, manifests do not have the same headers (column '{}' is missing).".format(col))
+
+        # newly found records will be added to the archive
+        new_rows = [row for row in rows if not archive.has_solution(row['solution_id'])]
+        for solution_id in dict.fromkeys([row['solution_id'] for row in new_rows]):
+            # a solutions dir is linked into the archive (its rows are appended to the manifest)
+            if not os.path.exists(self.files.get_archive_dir() + '/' + solution_id):
+                self.files.archive_solution(solution_id)
+        archive.append_rows(new_rows)
+        metrics.increment('manifest_rows_archived', len(new_rows))
+        return new_rows
 
     def get_assignments(self):
         '''
         Return a list of unique assignments that are in the manifest file.
         '''
-        if not os.path.exists(self.files.get_working_manifest_file()):
-            return []
-
-        with open(self.files.get_working_manifest_file(), 'r', encoding="utf8") as fin:
-            reader = csv.DictReader(fin)
-            return list(set([row['assignment_id'] for row in reader]))
+        return list(set([row['assignment_id'] for row in self._get_working_rows()]))
@@ -1,24 +1,60 @@
 import os
+import csv
 import shutil
+import hashlib
 from datetime import datetime
+from manifest_index import ManifestIndex
+import metrics
 
 MANIFEST_FILE = 'manifest.csv'
 OUTPUT_FILE = 'output.csv'
+DELTA_MANIFEST_FILE = 'delta.csv'  # new solutions of the working batch (in delta mode)
+DELTA_BASE_FILE = 'delta-base.csv'  # archived files relevant for the new solutions (in delta mode)
+FINGERPRINTS_FILE = 'fingerprints.sqlite'
+WATERMARK_FILE = 'watermark.json'  # createdAt of the newest downloaded solution (in the archive dir)
+CHECKPOINT_FILE = 'checkpoint.json'  # progress of the current run (in the working dir)
+SHARDS_DIR = 'shards'  # inputs and outputs of sharded comparator processes (in the working dir)
+STORE_DIR = '.store'  # content-addressed store of archived files (shared by all exercises)
 
 
 def mkdir(dir):
+    os.makedirs(dir, exist_ok=True)  # concurrent exercises may create the same (store) dir at the same time
     if not os.path.exists(dir):
-        os.makedirs(dir)
-        if not os.path.exists(dir):
-            raise RuntimeError("Unable to create directory {}".format(dir))
+        raise RuntimeError("Unable to create directory {}".format(dir))
+
+
+def file_hash(file):
+    '''
+    Compute SHA-256 hash (hex string) of the file contents.
+    '''
+    hash = hashlib.sha256()
+    with open(file, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            hash.update(chunk)
+    return hash.hexdigest()
+
+
+def link_or_copy(src, dst):
+    '''
+    Create a hardlink dst pointing to src. If that is not possible (e.g., different filesystems), the file is copied.
+    '''
+    try:
+        os.link(src, dst)
+        metrics.increment('files_linked')
+    except OSError:
+        shutil.copy2(src, dst)
+        metrics.increment('files_copied')
+        metrics.increment('bytes_copied', os.path.getsize(dst))
 
 
 class FilesManager:
     '''
     Handles path assembling and basic fs operations required for managing solutions. There are 3 important dirs:
-      - working_dir where current batch is downloaded
+      - working_dir where current batch is downloaded (each exercise has its own)
       - last_dir where last downloaded batch was stored (so we can compare it with current batch)
       - archive_dir where all solutions are accumulated continuously
+    Files in the archive are hardlinks into a content-addressed store, so identical files are stored only once
+    and archiving a solution does not copy its data.
     '''
 
     def __init__(self, config, exercise):
@@ -26,13 +62,18 @@ class FilesManager:
         Initialize the manager using directory configs and selected exercise identifier.
         The exercise identifier is used as part of paths, so the detector can handle multiple exercises.
         '''
-        self.working_dir = config['working']
+        self.working_dir = config['working'] + '/' + exercise
         self.last_dir = config['last_batch'] + '/' + exercise
         self.archive_dir = config['archive'] + '/' + exercise
+        self.store_dir = config['archive'] + '/' + STORE_DIR
         self.logs_dir = config['logs']
+        self.metrics_dir = config.get('metrics', config['logs'])
+        self.prometheus_dir = config.get('prometheus')
         self.exercise = exercise
+        self.archive_index = None
         mkdir(self.last_dir)
         mkdir(self.archive_dir)
+        mkdir(self.store_dir)
 
     def working_dir_exists(self):
         return os.path.exists(self.working_dir)
@@ -53,6 +94,15 @@ class FilesManager:
     def get_comparator_output_file(self):
         return self.working_dir + '/' + OUTPUT_FILE
 
+    def get_checkpoint_file(self):
+        return self.working_dir + '/' + CHECKPOINT_FILE
+
+    def get_delta_manifest_file(self):
+        return self.working_dir + '/' + DELTA_MANIFEST_FILE
+
+    def get_shards_dir(self):
+        return self.working_dir + '/' + SHARDS_DIR
+
     def get_last_dir(self):
         return self.last_dir
 
@@ -65,6 +115,67 @@ class FilesManager:
     def get_archive_manifest_file(self):
         return self.archive_dir + '/' + MANIFEST_FILE
 
+    def get_delta_base_file(self):
+        return self.archive_dir + '/' + DELTA_BASE_FILE  # paths in archive manifests are relative to archive dir
+
+    def get_fingerprint_index_file(self):
+        return self.archive_dir + '/' + FINGERPRINTS_FILE
+
+    def get_watermark_file(self):
+        return self.archive_dir + '/' + WATERMARK_FILE
+
+    def get_archive_index(self):
+        '''
+        Return (lazily opened) index of the archive manifest.
+        '''
+        if self.archive_index is None:
+            self.archive_index = ManifestIndex(self.get_archive_manifest_file())
+        else:
+            self.archive_index.refresh()  # the manifest may have been compacted since (long-running processes)
+        return self.archive_index
+
+    def replace_archive_manifest(self, header, rows):
+        '''
+        Rewrite the archive manifest with given rows (dicts), the archive index is rebuilt.
+        '''
+        if self.archive_index is not None:
+            self.archive_index.close()
+            self.archive_index = None
+
+        tmp = self.get_archive_manifest_file() + '.tmp'
+        with open(tmp, 'w', encoding="utf8", newline='') as fout:
+            writer = csv.DictWriter(fout, fieldnames=header)
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(tmp, self.get_archive_manifest_file())
+        self.get_archive_index()  # detects the modified manifest and rebuilds itself
+
+    def get_archived_solution_dirs(self):
+        '''
+        Return names of all (solution) sub-directories of the archive.
+        '''
+        return [entry for entry in os.listdir(self.archive_dir) if os.path.isdir(self.archive_dir + '/' + entry)]
+
+    def remove_archived_solution(self, solution_id):
+        shutil.rmtree(self.archive_dir + '/' + solution_id)
+
+    def collect_store_garbage(self):
+        '''
+        Remove objects from the store that are not linked from anywhere (no archive, last, or working dir holds them).
+        Must not run concurrently with a detection (a freshly stored object may not be linked yet).
+        Returns the number of removed objects and their total size.
+        '''
+        count = 0
+        size = 0
+        for dir, _, files in os.walk(self.store_dir):
+            for file in files:
+                stat = os.stat(dir + '/' + file)
+                if stat.st_nlink == 1:
+                    os.unlink(dir + '/' + file)
+                    count += 1
+                    size += stat.st_size
+        return count, size
+
     def get_log_file(self):
         '''
         Return new log file name composed from current time and selected exercise.
@@ -76,13 +187,64 @@ class FilesManager:
             raise RuntimeError("Log file {} already exists.".format(log_file))
         return log_file
 
+    def _store_file(self, file):
+        '''
+        Make sure the file contents is in the store and return path to the stored object.
+        '''
+        hash = file_hash(file)
+        mkdir(self.store_dir + '/' + hash[:2])
+        stored = self.store_dir + '/' + hash[:2] + '/' + hash
+        if not os.path.exists(stored):
+            tmp = stored + '.tmp' + str(os.getpid())
+            link_or_copy(file, tmp)
+            os.replace(tmp, stored)  # atomic, so the store never holds partial objects
+        return stored
+
+    def _link_tree(self, src_dir, dst_dir):
+        '''
+        Replicate directory tree src_dir as dst_dir where all files are hardlinks to the store.
+        '''
+        for dir, subdirs, files in os.walk(src_dir):
+            rel_dir = os.path.relpath(dir, src_dir)
+            target_dir = dst_dir if rel_dir == '.' else dst_dir + '/' + rel_dir
+            mkdir(target_dir)
+            for file in files:
+                target = target_dir + '/' + file
+                if os.path.exists(target):
+                    os.unlink(target)
+                link_or_copy(self._store_file(dir + '/' + file), target)
+
+    def archive_solution(self, solution_id):
+        '''
+        Add solution from the working dir into the archive (files are linked through the store).
+        '''
+        self._link_tree(self.working_dir + '/' + solution_id, self.archive_dir + '/' + solution_id)
+
+    def get_metrics_file(self):
+        '''
+        Return new JSON metrics file name composed from current time and selected exercise.
+        '''
+        mkdir(self.metrics_dir)
+        return self.metrics_dir + '/' + datetime.now().strftime("%Y-%m-%d-%H%M%S--") + self.exercise + '.json'
+
+    def get_prometheus_file(self):
+        '''
+        Return the Prometheus textfile-collector file of selected exercise (None if not configured).
+        '''
+        if not self.prometheus_dir:
+            return None
+        mkdir(self.prometheus_dir)
+        return self.prometheus_dir + '/plagiarisms_' + self.exercise + '.prom'
+
     def update_solution_dirs(self):
         '''
         Lay foundation of archive if it does not exist and replace last dir with working dir.
         '''
         if not os.path.exists(self.get_archive_manifest_file()):
-            shutil.rmtree(self.archive_dir)
-            shutil.copytree(self.working_dir, self.archive_dir)
+            for entry in os.listdir(self.working_dir):  # only solution dirs, not files generated by the tools
+                if os.path.isdir(self.working_dir + '/' + entry):
+                    self.archive_solution(entry)  # the archive dir is kept (it may hold the watermark already)
+            shutil.copy2(self.get_working_manifest_file(), self.get_archive_manifest_file())  # manifest is appended
 
         shutil.rmtree(self.last_dir)
         shutil.move(self.working_dir, self.last_dir)
@@ -0,0 +1,196 @@
+import re
+import hashlib
+import sqlite3
+
+# identifiers, numbers, string/char literals, and any other non-white character (operators, brackets, ...)
+_TOKEN_REGEX = re.compile(rb'([A-Za-z_][A-Za-z0-9_]*)|([0-9][0-9A-Za-z_.]*)|("(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\')|\S')
+_SQL_CHUNK = 500  # max. number of values in one SQL IN (...) condition
+
+
+def tokenize(data, normalize=True):
+    '''
+    Split source code (bytes) into tokens. Returns a list of (token, start, end) tuples (byte offsets).
+    If normalize is true, identifiers, numbers, and literals are replaced by placeholders
+    (so renaming variables does not affect the result).
+    '''
+    tokens = []
+    for match in _TOKEN_REGEX.finditer(data):
+        token = match.group(0)
+        if normalize:
+            if match.group(1) is not None:
+                token = b'I'
+            elif match.group(2) is not None:
+                token = b'N'
+            elif match.group(3) is not None:
+                token = b'S'
+        tokens.append((token, match.start(), match.end()))
+    return tokens
+
+
+def _hash(tokens):
+    digest = hashlib.blake2b(b'\x00'.join(tokens), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)  # signed 64-bit integer fits SQLite INTEGER
+
+
+def fingerprint(data, k, window, normalize=True):
+    '''
+    Compute winnowed fingerprints of source code (bytes).
+    Returns a list of (hash, start, end) tuples, where start-end is the byte range of the hashed k-gram.
+    '''
+    tokens = tokenize(data, normalize)
+    if len(tokens) < k:
+        return []
+
+    texts = [token[0] for token in tokens]
+    grams = [(_hash(texts[i:i + k]), tokens[i][1], tokens[i + k - 1][2]) for i in range(len(tokens) - k + 1)]
+    if len(grams) <= window:
+        return [min(grams)]
+
+    result = []
+    last = None
+    for i in range(len(grams) - window + 1):
+        # select the rightmost minimal hash in the window
+        best = i
+        for j in range(i + 1, i + window):
+            if grams[j][0] <= grams[best][0]:
+                best = j
+        if best != last:
+            result.append(grams[best])
+            last = best
+    return result
+
+
+def fingerprint_file(file, k, window, normalize=True):
+    with open(file, 'rb') as fp:
+        return fingerprint(fp.read(), k, window, normalize)
+
+
+def merge_fragments(pairs, max_gap=0):
+    '''
+    Merge matched k-gram pairs (o1, e1, o2, e2) into fragments. Pairs that overlap (or are at most max_gap bytes
+    apart) in both files are joined. Returns a list of (o1, e1, o2, e2) tuples sorted by o1.
+    '''
+    fragments = []
+    for o1, e1, o2, e2 in sorted(pairs):
+        if fragments:
+            last = fragments[-1]
+            if o1 <= last[1] + max_gap and last[2] <= o2 <= last[3] + max_gap:
+                fragments[-1] = (last[0], max(last[1], e1), last[2], max(last[3], e2))
+                continue
+        fragments.append((o1, e1, o2, e2))
+    return fragments
+
+
+def coverage(intervals):
+    '''
+    Return the total length of the union of given (start, end) intervals.
+    '''
+    total = 0
+    current_start = current_end = None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+class FingerprintIndex:
+    '''
+    Persistent inverted index (SQLite) of winnowed fingerprints of archived files.
+    It is updated incrementally as new solutions are merged into the archive.
+    '''
+
+    def __init__(self, db_file, k, window, normalize=True, read_only=False):
+        self.k = k
+        self.window = window
+        self.normalize = normalize
+        if read_only:  # used by parallel workers, the index must exist already
+            self.db = sqlite3.connect('file:{}?mode=ro'.format(db_file), uri=True)
+            return
+
+        self.db = sqlite3.connect(db_file)
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files (file_id TEXT PRIMARY KEY, solution_id TEXT, author_id TEXT, path TEXT)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints (hash INTEGER, file_id TEXT, start INTEGER, end INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS fingerprints_hash ON fingerprints (hash)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS fingerprints_file ON fingerprints (file_id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_solution ON files (solution_id)")
+
+        # fingerprints computed with different parameters are useless
+        params = "{} {} {}".format(k, window, normalize)
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'params'").fetchone()
+        if row is None or row[0] != params:
+            with self.db:
+                self.db.execute("DELETE FROM files")
+                self.db.execute("DELETE FROM fingerprints")
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('params', ?)", (params,))
+
+    def get_file_count(self):
+        return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def has_file(self, file_id):
+        return self.db.execute("SELECT 1 FROM files WHERE file_id = ?", (file_id,)).fetchone() is not None
+
+    def add_file(self, file_id, solution_id, author_id, path):
+        '''
+        Fingerprint given file and add it to the index (nothing happens if the file is already indexed).
+        '''
+        if self.has_file(file_id):
+            return
+        fingerprints = fingerprint_file(path, self.k, self.window, self.normalize)
+        with self.db:
+            self.db.execute("INSERT INTO files (file_id, solution_id, author_id, path) VALUES (?, ?, ?, ?)",
+                            (file_id, solution_id, author_id, path))
+            self.db.executemany("INSERT INTO fingerprints (hash, file_id, start, end) VALUES (?, ?, ?, ?)",
+                                [(hash, file_id, start, end) for hash, start, end in fingerprints])
+
+    def remove_solutions(self, solution_ids):
+        '''
+        Remove all files of given solutions from the index.
+        '''
+        solution_ids = list(solution_ids)
+        with self.db:
+            for i in range(0, len(solution_ids), _SQL_CHUNK):
+                chunk = solution_ids[i:i + _SQL_CHUNK]
+                marks = ','.join('?' * len(chunk))
+                self.db.execute("DELETE FROM fingerprints WHERE file_id IN (SELECT file_id FROM files WHERE solution_id IN ({}))"
+                                .format(marks), chunk)
+                self.db.execute("DELETE FROM files WHERE solution_id IN ({})".format(marks), chunk)
+
+    def count_shared(self, hashes):
+        '''
+        Return a dict file_id -> number of given (distinct) hashes that are present in that indexed file.
+        '''
+        hashes = list(set(hashes))
+        result = {}
+        for i in range(0, len(hashes), _SQL_CHUNK):
+            chunk = hashes[i:i + _SQL_CHUNK]
+            query = "SELECT file_id, COUNT(DISTINCT hash) FROM fingerprints WHERE hash IN ({}) GROUP BY file_id".format(
+                ','.join('?' * len(chunk)))
+            for file_id, count in self.db.execute(query, chunk):
+                result[file_id] = result.get(file_id, 0) + count
+        return result
+
+    def find_matches(self, hashes):
+        '''
+        Return a dict hash -> list of (file_id, solution_id, author_id, start, end) of all indexed occurrences.
+        '''
+        hashes = list(set(hashes))
+        result = {}
+        for i in range(0, len(hashes), _SQL_CHUNK):
+            chunk = hashes[i:i + _SQL_CHUNK]
+            query = ("SELECT f.hash, f.file_id, s.solution_id, s.author_id, f.start, f.end FROM fingerprints f "
+                     "JOIN files s ON s.file_id = f.file_id WHERE f.hash IN ({})").format(','.join('?' * len(chunk)))
+            for hash, *occurrence in self.db.execute(query, chunk):
+                result.setdefault(hash, []).append(tuple(occurrence))
+        return result
+
+    def close(self):
+        self.db.close()
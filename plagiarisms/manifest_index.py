@@ -0,0 +1,127 @@
+import os
+import csv
+import json
+import sqlite3
+
+
+def get_index_file(manifest_file):
+    '''
+    Return path to the index database that belongs to given manifest CSV file.
+    '''
+    return os.path.splitext(manifest_file)[0] + '.sqlite'
+
+
+class ManifestIndex:
+    '''
+    Persistent index of a manifest CSV file kept in a SQLite database next to the CSV file.
+    The CSV file remains the primary data (it is passed to the comparator), new rows are appended to both.
+    If the CSV file is modified by someone else, the index detects it (by size and mtime) and rebuilds itself.
+    '''
+
+    def __init__(self, manifest_file, solution_id_col='solution_id'):
+        self.manifest_file = manifest_file
+        self.solution_id_col = solution_id_col
+        self.db = sqlite3.connect(get_index_file(manifest_file))
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS rows (seq INTEGER PRIMARY KEY, solution_id TEXT, data TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS solutions (solution_id TEXT PRIMARY KEY)")
+        self.header = None
+        if self._get_meta('stamp') != self._get_csv_stamp():
+            self._rebuild()
+        else:
+            self.header = json.loads(self._get_meta('header'))
+
+    def _get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _get_csv_stamp(self):
+        '''
+        Return a string that changes whenever the CSV file is modified.
+        '''
+        if not os.path.exists(self.manifest_file):
+            return json.dumps(None)
+        stat = os.stat(self.manifest_file)
+        return json.dumps([stat.st_size, stat.st_mtime_ns])
+
+    def _insert_rows(self, rows):
+        for row in rows:
+            solution_id = row[self.solution_id_col]
+            self.db.execute("INSERT INTO rows (solution_id, data) VALUES (?, ?)",
+                            (solution_id, json.dumps([row.get(col) for col in self.header])))
+            self.db.execute("INSERT OR IGNORE INTO solutions (solution_id) VALUES (?)", (solution_id,))
+
+    def _rebuild(self):
+        '''
+        Re-create the index from the CSV file.
+        '''
+        with self.db:
+            self.db.execute("DELETE FROM rows")
+            self.db.execute("DELETE FROM solutions")
+            self.header = []
+            if os.path.exists(self.manifest_file):
+                with open(self.manifest_file, 'r', encoding="utf8", newline='') as f:
+                    reader = csv.DictReader(f)
+                    self.header = list(reader.fieldnames or [])
+                    self._insert_rows(reader)
+            self._set_meta('header', json.dumps(self.header))
+            self._set_meta('stamp', self._get_csv_stamp())
+
+    def refresh(self):
+        '''
+        Rebuild the index if the CSV file has been modified by someone else since the index was opened.
+        '''
+        if self._get_meta('stamp') != self._get_csv_stamp():
+            self._rebuild()
+
+    def exists(self):
+        return os.path.exists(self.manifest_file)
+
+    def get_header(self):
+        return self.header
+
+    def has_solution(self, solution_id):
+        return self.db.execute("SELECT 1 FROM solutions WHERE solution_id = ?", (solution_id,)).fetchone() is not None
+
+    def get_solutions(self):
+        return [row[0] for row in self.db.execute("SELECT solution_id FROM solutions")]
+
+    def get_rows(self):
+        '''
+        Generator yielding all rows (as dicts) in the order of the CSV file.
+        '''
+        for (data,) in self.db.execute("SELECT data FROM rows ORDER BY seq"):
+            yield dict(zip(self.header, json.loads(data)))
+
+    def append_rows(self, rows):
+        '''
+        Append rows (dicts) at the end of the CSV file and to the index.
+        '''
+        rows = list(rows)
+        if not rows:
+            return
+
+        with open(self.manifest_file, 'a', encoding="utf8", newline='') as fout:
+            writer = csv.DictWriter(fout, fieldnames=self.header)
+            writer.writerows(rows)
+
+        with self.db:
+            self._insert_rows(rows)
+            self._set_meta('stamp', self._get_csv_stamp())
+
+    def export_csv(self, file, row_filter=None):
+        '''
+        Write the indexed rows (possibly only rows accepted by given filter callable) into a new CSV file.
+        '''
+        with open(file, 'w', encoding="utf8", newline='') as fout:
+            writer = csv.writer(fout)
+            writer.writerow(self.header)
+            for row in self.get_rows():
+                if row_filter is None or row_filter(row):
+                    writer.writerow([row[col] for col in self.header])
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_counters = {}  # global counters (API calls, copied bytes, ...), incremented from anywhere in the process
+
+
+def increment(name, value=1):
+    '''
+    Increment a global counter (thread safe).
+    '''
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def get_counters():
+    with _lock:
+        return dict(_counters)
+
+
+def reset_counters():
+    with _lock:
+        _counters.clear()
+
+
+def _cpu_time():
+    '''
+    Return CPU time (user + system) consumed by this process and all its finished child processes.
+    '''
+    self = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self.ru_utime + self.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _write_atomically(file, contents):
+    tmp = file + '.tmp'
+    with open(tmp, 'w', encoding="utf8") as fp:
+        fp.write(contents)
+    os.replace(tmp, file)  # collectors must never see a half-written file
+
+
+class RunMetrics:
+    '''
+    Collects metrics of one detection run -- wall and CPU time of individual stages and the counters they increment.
+    The metrics are exported as a JSON file and as a Prometheus textfile-collector file.
+    '''
+
+    def __init__(self, exercise):
+        self.exercise = exercise
+        self.started = time.time()
+        self.success = False
+        self.stages = {}
+        reset_counters()
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Context manager that measures one stage of the run.
+        '''
+        wall = time.perf_counter()
+        cpu = _cpu_time()
+        counters = get_counters()
+        try:
+            yield
+        finally:
+            current = get_counters()
+            self.stages[name] = {
+                'wall': time.perf_counter() - wall,
+                'cpu': _cpu_time() - cpu,
+                'counters': {key: value - counters.get(key, 0) for key, value in current.items()
+                             if value != counters.get(key, 0)},
+            }
+
+    def to_dict(self):
+        return {
+            'exercise': self.exercise,
+            'started': self.started,
+            'finished': time.time(),
+            'success': self.success,
+            'stages': self.stages,
+            'counters': get_counters(),
+        }
+
+    def write_json(self, file):
+        _write_atomically(file, json.dumps(self.to_dict(), indent=2))
+
+    def write_prometheus(self, file):
+        data = self.to_dict()
+        labels = 'exercise="{}"'.format(self.exercise)
+        lines = [
+            '# HELP plagiarisms_stage_wall_seconds Wall time of a stage of the last detection run.',
+            '# TYPE plagiarisms_stage_wall_seconds gauge',
+        ]
+        lines += ['plagiarisms_stage_wall_seconds{{{},stage="{}"}} {}'.format(labels, name, stage['wall'])
+                  for name, stage in data['stages'].items()]
+        lines += [
+            '# HELP plagiarisms_stage_cpu_seconds CPU time (including child processes) of a stage of the last run.',
+            '# TYPE plagiarisms_stage_cpu_seconds gauge',
+        ]
+        lines += ['plagiarisms_stage_cpu_seconds{{{},stage="{}"}} {}'.format(labels, name, stage['cpu'])
+                  for name, stage in data['stages'].items()]
+        lines += [
+            '# HELP plagiarisms_run_count Counters (rows, records, bytes, API calls) of the last detection run.',
+            '# TYPE plagiarisms_run_count gauge',
+        ]
+        lines += ['plagiarisms_run_count{{{},name="{}"}} {}'.format(labels, name, value)
+                  for name, value in sorted(data['counters'].items())]
+        lines += [
+            '# HELP plagiarisms_last_run_timestamp_seconds When the last detection run finished.',
+            '# TYPE plagiarisms_last_run_timestamp_seconds gauge',
+            'plagiarisms_last_run_timestamp_seconds{{{}}} {}'.format(labels, data['finished']),
+            '# HELP plagiarisms_last_run_success Whether the last detection run succeeded.',
+            '# TYPE plagiarisms_last_run_success gauge',
+            'plagiarisms_last_run_success{{{}}} {}'.format(labels, 1 if self.success else 0),
+        ]
+        _write_atomically(file, "\n".join(lines) + "\n")
@@ -1,9 +1,14 @@
 import subprocess
 import json
 import logging
+import threading
+import metrics
 
 group_cache = None
 
+_backend = 'cli'  # 'cli' (recodex process per call) or 'client' (in-process client with persistent session)
+_thread_data = threading.local()  # each worker thread keeps its own client (and its connection pool)
+
 # Low level functions for calling ReCodEx CLI process
 
 
@@ -12,6 +17,7 @@ def _recodex_call(args, **kwargs):
     Invoke recodex CLI process with given set of arguments.
     On success, stdout is returned as string. On error, None is returned and the message is printed out.
     '''
+    metrics.increment('api_calls')
     res = subprocess.run(['recodex'] + args, capture_output=True, **kwargs)
     if res.returncode == 0:
         return res.stdout
@@ -20,12 +26,40 @@ def _recodex_call(args, **kwargs):
         return None
 
 
+def _get_client():
+    '''
+    Return in-process ReCodEx client of the current thread (created lazily from the session of the CLI tool).
+    '''
+    client = getattr(_thread_data, 'client', None)
+    if client is None:
+        try:
+            from recodex import client_factory
+        except ImportError:
+            raise RuntimeError("The 'client' backend requires recodex-pylib (see requirements-client.txt).")
+        client = client_factory.get_client_from_session()
+        _thread_data.client = client
+    return client
+
+
+def set_backend(backend):
+    '''
+    Select how the upload calls are performed ('cli' or 'client').
+    '''
+    global _backend
+    if backend not in ['cli', 'client']:
+        raise RuntimeError("Unknown ReCodEx API backend '{}'.".format(backend))
+    _backend = backend
+
+
 def create_batch(tool, tool_params):
     '''
     Create a new upload batch for detected plagiarisms and return its ID
     '''
     logging.getLogger().debug("ReCodEx API: creating new batch...")
-    id = _recodex_call(['plagiarisms', 'create-batch', '--', tool, tool_params]).decode('ascii').strip()
+    res = _recodex_call(['plagiarisms', 'create-batch', '--', tool, tool_params])
+    if res is None:
+        raise RuntimeError("Unable to create a new batch.")
+    id = res.decode('ascii').strip()
     logging.getLogger().debug("ReCodEx API: new batch {} created".format(id))
     return id
 
@@ -37,10 +71,28 @@ def close_batch(id, assignments):
     '''
     logging.getLogger().debug("ReCodEx API: closing batch {}".format(id))
     input = " ".join(assignments)
-    _recodex_call(['plagiarisms', 'update-batch', '--upload-completed', '--assignments', id], input=input.encode())
+    res = _recodex_call(['plagiarisms', 'update-batch', '--upload-completed', '--assignments', id], input=input.encode())
+    if res is None:
+        raise RuntimeError("Unable to close batch {}.".format(id))
 
 
 def add_similarity(batch_id, solution_id, data):
+    '''
+    Upload one similarity record into given batch. Returns True if the upload was confirmed.
+    '''
     logging.getLogger().debug("ReCodEx API: adding similarity to batch {}, solution {}, author {}"
                               .format(batch_id, solution_id, data['authorId']))
-    _recodex_call(['plagiarisms', 'add-similarity', '--json', batch_id, solution_id], input=json.dumps(data).encode())
+    if _backend == 'client':
+        client = _get_client()
+        from recodex.generated.swagger_client import DefaultApi
+        metrics.increment('api_calls')
+        client.send_request_by_callback(
+            DefaultApi.plagiarism_presenter_action_add_similarities,
+            path_params={"id": batch_id, "solutionId": solution_id},
+            body=data
+        ).check_success()
+        return True
+
+    res = _recodex_call(['plagiarisms', 'add-similarity', '--json', batch_id, solution_id],
+                        input=json.dumps(data).encode())
+    return res is not None
@@ -0,0 +1,75 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import recodex_api
+import metrics
+
+
+class SimilarityUploader:
+    '''
+    Uploads similarity records into an open batch using a bounded pool of worker threads.
+    Failed uploads are retried, the whole upload fails if any record cannot be confirmed.
+    '''
+
+    def __init__(self, config):
+        '''
+        Initialize the uploader using the `uploader` section of the config.
+        '''
+        self.workers = max(1, int(config.get('workers', 1)))
+        self.max_pending = self.workers * 4  # how many records may wait in the queue (bounds memory)
+        self.retries = int(config.get('retries', 3))
+        self.retry_delay = float(config.get('retry_delay', 1.0))
+        recodex_api.set_backend(config.get('backend', 'cli'))
+
+    def _upload_one(self, batch_id, similarity, index, on_uploaded):
+        '''
+        Upload one record, retry (with exponential delays) if it fails.
+        '''
+        attempt = 0
+        while True:
+            try:
+                if similarity.upload(batch_id):
+                    metrics.increment('records_uploaded')
+                    if on_uploaded is not None:
+                        on_uploaded(index)
+                    return
+                error = "the API call failed"
+            except Exception as e:
+                error = str(e)
+
+            attempt += 1
+            if attempt > self.retries:
+                raise RuntimeError("Unable to upload similarity of solution {} (author {}): {}".format(
+                    similarity.solution_id, similarity.author_id, error))
+
+            metrics.increment('upload_retries')
+            delay = self.retry_delay * 2 ** (attempt - 1)
+            logging.getLogger().warning("Upload of similarity of solution {} failed ({}), retrying in {}s...".format(
+                similarity.solution_id, error, delay))
+            time.sleep(delay)
+
+    def upload(self, batch_id, similarities, skip=None, on_uploaded=None):
+        '''
+        Upload all similarities (any iterable of DetectedSimilarity objects) into given batch.
+        Records are identified by their index in the iterable; records for which skip(index) is true are not uploaded
+        and on_uploaded(index) is invoked (from a worker thread) when a record is confirmed.
+        Returns the number of uploaded records when all of them are confirmed, raises an exception otherwise.
+        '''
+        count = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = set()
+            for index, similarity in enumerate(similarities):
+                if skip is not None and skip(index):
+                    continue
+                if len(pending) >= self.max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()  # re-raises upload errors
+
+                pending.add(executor.submit(self._upload_one, batch_id, similarity, index, on_uploaded))
+                count += 1
+
+            for future in wait(pending).done:
+                future.result()
+
+        return count
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+#
+# Micro-benchmark of parsing large `assignments get-solutions` outputs of the CLI (YAML vs. JSON parsers).
+#
+
+import argparse
+import io
+import json
+import random
+import time
+from ruamel.yaml import YAML
+import recodex_api
+
+
+def generate_solutions(count, rnd):
+    '''
+    Generate a list of solution entities resembling the output of the ReCodEx API.
+    '''
+    solutions = []
+    for i in range(count):
+        score = rnd.random()
+        solutions.append({
+            'id': "solution-{:08d}".format(i),
+            'note': '',
+            'assignmentId': 'assignment-00000001',
+            'authorId': "user-{:06d}".format(rnd.randrange(count // 4 + 1)),
+            'createdAt': 1672936007 + i * 37,
+            'accepted': rnd.random() < 0.1,
+            'isBestSolution': rnd.random() < 0.3,
+            'review': {'startedAt': None, 'closedAt': None, 'issues': 0},
+            'permissionHints': {'viewDetail': True, 'setAccepted': True, 'review': True, 'delete': False},
+            'lastSubmission': {
+                'id': "submission-{:08d}".format(i),
+                'submittedAt': 1672936007 + i * 37,
+                'evaluation': {
+                    'score': score,
+                    'points': int(score * 10),
+                    'initFailed': rnd.random() < 0.05,
+                    'evaluatedAt': 1672936017 + i * 37,
+                },
+            },
+            'submissions': ["submission-{:08d}".format(i - j) for j in range(rnd.randrange(1, 4))],
+        })
+    return solutions
+
+
+def measure(parser, payload, repeat):
+    '''
+    Return the best time (of repeat attempts) of parsing the payload.
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parser(payload)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--solutions", type=int, nargs='+', default=[100, 1000, 10000],
+                        help="Sizes of generated get-solutions outputs (number of solutions).")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of attempts (the best time is reported).")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the generator.")
+    args = parser.parse_args()
+
+    parsers = [('ruamel.yaml (safe)', lambda payload: YAML(typ="safe").load(payload), 'yaml'),
+               ('json (stdlib)', json.loads, 'json')]
+    try:
+        import orjson
+        parsers.append(('orjson', orjson.loads, 'json'))
+    except ImportError:
+        pass
+    parsers.append(('recodex_api', recodex_api._parse_payload, 'json'))
+
+    rnd = random.Random(args.seed)
+    print("{:>10} {:>12} {:>12}  {:<20} {:>10}".format('solutions', 'yaml [B]', 'json [B]', 'parser', 'time [ms]'))
+    for count in args.solutions:
+        solutions = generate_solutions(count, rnd)
+        payloads = {'json': json.dumps(solutions).encode('utf8')}
+        buffer = io.BytesIO()
+        YAML(typ="safe").dump(solutions, buffer)
+        payloads['yaml'] = buffer.getvalue()
+
+        for name, parse, format in parsers:
+            if parse(payloads[format]) != solutions:
+                raise RuntimeError("Parser {} returned different data.".format(name))
+            elapsed = measure(parse, payloads[format], args.repeat)
+            print("{:>10} {:>12} {:>12}  {:<20} {:>10.2f}".format(count, len(payloads['yaml']), len(payloads['json']),
+                                                                  name, elapsed * 1000))
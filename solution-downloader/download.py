@@ -2,11 +2,17 @@
 
 import argparse
 import os
+import csv
 import glob
 import pathlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from ruamel.yaml import YAML
 import recodex_api
 from metadata import MetadataHandler
+from download_state import DownloadState
+
+STATS_COLUMNS = ['solution_id', 'bytes', 'download_time', 'extract_time', 'in_memory']
 
 
 def find_file(file, fallback_wildcard):
@@ -62,6 +68,161 @@ def get_groups(config_groups):
     return groups
 
 
+def _process_solution(metadata, solution_id, dest_dir, manifest_per_file, state):
+    '''
+    Download one solution (if dest_dir is set) and assemble its manifest rows (executed by a worker thread).
+    The metadata is a snapshot of the handler (with the solution set). Solutions that are already completely
+    downloaded (according to the download state) are skipped.
+    Returns path, manifest rows (empty if no manifest is written), download statistics, and file list for
+    the download state (None if not downloaded).
+    '''
+    path = None
+    stats = None
+    files = None
+    extracted = None  # relative paths of files in the downloaded zip
+    if dest_dir:  # Handle download
+        path = metadata.get_path()  # of current solution
+        if not state.is_complete(solution_id, path):
+            stats = dict(recodex_api.download_solution(solution_id, path, dest_dir), solution_id=solution_id)
+            extracted = stats.pop('files')
+            files = state.scan(path)
+    rows = metadata.get_manifest_rows(manifest_per_file, extracted) if metadata.manifest_fp is not None else []
+    return path, rows, stats, files
+
+
+def download_solutions(config, exercise, dest_dir=None, manifest=None, manifest_per_file=False, config_dir='.',
+                       user_cache=None, log=print, jobs=1, stats=None, resume=True,
+                       refresh=False, local_files=False, cache_ttl=0):
+    '''
+    Library interface of the downloader (the same process as the CLI, but the config is passed as a dict).
+    Generator that scans all relevant groups and assignments of the exercise and yields (path, rows) for each
+    solution that passes the filter, where path is the directory where the solution was downloaded (None if dest_dir
+    is not set) and rows are its manifest rows (dicts column => value). The solution is downloaded before it is yielded.
+    The rows are assembled (and written into the manifest CSV file) only if manifest is set, they are empty otherwise.
+    The user_cache (dict) may be shared by multiple invocations, progress messages are passed to the log callable.
+    Solutions are downloaded by a pool of `jobs` threads, but they are yielded (and written into the manifest)
+    in the same order as if they were downloaded one by one.
+    If stats is set, download statistics of each solution (bytes, download and extraction times) are saved into that
+    CSV file; the totals are logged at the end.
+    Completely downloaded solutions are recorded in a state file in dest_dir, so an interrupted download can be resumed
+    (recorded solutions with intact files are not downloaded again). If resume is false, the old state is discarded.
+    The `backend` config key selects whether the API is called through the CLI ('cli', default) or the in-process
+    client ('client'). If the `response_cache` section is configured, outputs of read API calls are cached on disk;
+    refresh means that all data are loaded again (and the cache is updated).
+    Groups and assignments are kept in memory for cache_ttl seconds (useful when the downloader is invoked
+    repeatedly by a resident process), they are loaded again in each invocation by default.
+    If local_files is set, per-file manifest rows are assembled from the downloaded files (without extra API calls),
+    so the manifest must not reference attributes of file entities (except `file.name`) or zip entries.
+    '''
+    if exercise not in config.get('exercises', {}):
+        raise RuntimeError("Invalid exercise identifier '{}'. Config holds exercises '{}'.".format(
+            exercise, "', '".join(config.get('exercises', {}).keys())))
+
+    if manifest_per_file and not manifest and not dest_dir:
+        raise RuntimeError("The manifest_per_file is only valid when both manifest is written and dest_dir is set.")
+
+    if local_files and not dest_dir:
+        raise RuntimeError("The local_files option is only valid when dest_dir is set (the files are downloaded).")
+
+    # Prepare destination directory
+    state = None
+    if dest_dir is not None:
+        pathlib.Path(dest_dir).mkdir(parents=True, exist_ok=True)
+        if not os.path.exists(dest_dir):
+            raise RuntimeError("Unable to create destination directory '{}'.".format(dest_dir))
+        state = DownloadState(dest_dir, resume)
+
+    # Prepare metadata handler which generates paths and saves manifest
+    metadata = MetadataHandler(dest_dir, config, config_dir, user_cache, local_files)
+    if manifest:
+        metadata.open_mainfest(manifest, manifest_per_file)
+
+    # Find assignments for selected exercise
+    exercise_id = config['exercises'][exercise]
+    recodex_api.reset_caches(cache_ttl)  # the module may stay loaded (library), the caches and maxAge may be outdated
+    recodex_api.set_backend(config.get('backend', 'cli'))
+    response_cache = config.get('response_cache') or {}
+    cache_dir = os.path.join(config_dir, response_cache['dir']) if response_cache.get('dir') else None
+    recodex_api.set_response_cache(cache_dir, response_cache.get('ttl'),
+                                   response_cache.get('max_size', 64 * 1024 * 1024), refresh)
+
+    pending = deque()  # futures of solutions being processed (in the order of the listing)
+    executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+
+    totals = dict.fromkeys(['solutions', 'skipped'] + STATS_COLUMNS[1:], 0)
+    stats_fp = open(stats, 'w', encoding="utf8", newline='') if stats else None
+    stats_writer = csv.DictWriter(stats_fp, fieldnames=STATS_COLUMNS) if stats_fp else None
+    if stats_writer:
+        stats_writer.writeheader()
+
+    def finish_solution():
+        path, rows, solution_stats, files = pending.popleft().result()
+        metadata.write_manifest(rows)
+        if files is not None:
+            state.record(solution_stats['solution_id'], path, files)
+        elif path is not None:
+            totals['skipped'] += 1
+        if solution_stats is not None:
+            totals['solutions'] += 1
+            for key in STATS_COLUMNS[1:]:
+                totals[key] += solution_stats[key]
+            if stats_writer:
+                stats_writer.writerow(solution_stats)
+        return path, rows
+
+    try:
+        # Iterate over all relevant groups, all their assignments, and all their solutions
+        log("Loading groups ...")
+        groups = get_groups(config.get('groups', []))
+        metadata.load_users([(group.get('primaryAdminsIds') or [None])[0] for group in groups])
+        group_counter = 0
+        for group in groups:
+            group_counter += 1
+            metadata.set_group(group)
+            log("Loading assignments in group {} ({} of {}) ...".format(group['id'], group_counter, len(groups)))
+            assignments = recodex_api.get_assignments(group['id'], exercise_id)
+            assignment_counter = 0
+            for assignment in assignments:
+                metadata.set_assignment(assignment)
+                assignment_counter += 1
+                log(" - Loading list of solutions of assignment {} ({} of {}) ...".format(
+                    assignment['id'], assignment_counter, len(assignments)))
+
+                solutions = recodex_api.get_solutions(assignment['id'], config.get('solutions', {}))
+                metadata.load_users([solution['authorId'] for solution in solutions])
+                solution_counter = 0
+                for solution in solutions:
+                    metadata.set_solution(solution)
+                    solution_counter += 1
+                    log("    - Processing solution {} ({} of {}) ..."
+                        .format(solution['id'], solution_counter, len(solutions)))
+
+                    pending.append(executor.submit(_process_solution, metadata.snapshot(), solution['id'],
+                                                   dest_dir, manifest_per_file, state))
+                    while len(pending) > 2 * jobs:  # bounded look-ahead, results are taken in order
+                        yield finish_solution()
+
+        while pending:
+            yield finish_solution()
+    finally:
+        for future in pending:
+            future.cancel()  # not started yet (e.g., when the generator is closed early or a download failed)
+        executor.shutdown()
+        metadata.close_manifest()
+        metadata.save_user_cache()
+        if stats_fp:
+            stats_fp.close()
+        if state:
+            state.close()
+
+    if totals['skipped']:
+        log("{} solutions were already downloaded (skipped).".format(totals['skipped']))
+    if totals['solutions']:
+        log("Downloaded {} solutions ({} bytes, {} archives kept in memory), download {:.2f}s, extraction {:.2f}s."
+            .format(totals['solutions'], totals['bytes'], totals['in_memory'], totals['download_time'],
+                    totals['extract_time']))
+
+
 if __name__ == "__main__":
     # Process program arguments...
     parser = argparse.ArgumentParser()
@@ -74,6 +235,22 @@ if __name__ == "__main__":
                         help="Path to csv file where the manifest will be saved (list of all downloaded solutions/files).")
     parser.add_argument("--manifest-per-file", default=False, action="store_true",
                         help="If present, the manifest file will hold one row per each downloaded file (not per solution).")
+    parser.add_argument("--manifest-local-files", default=False, action="store_true",
+                        help="Per-file manifest rows are assembled from the downloaded files (no extra API calls).")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of solutions downloaded (and extracted) concurrently.")
+    parser.add_argument("--rate-limit", type=float,
+                        help="Max. number of ReCodEx API calls per second (no limit by default).")
+    parser.add_argument("--stream-zip", default=False, action="store_true",
+                        help="Stream zip archives from the CLI into extraction (no zip files are saved in dest-dir).")
+    parser.add_argument("--zip-memory-limit", type=int,
+                        help="Streamed archives larger than this (bytes) are spooled to a temporary file (16MiB default).")
+    parser.add_argument("--no-resume", default=False, action="store_true",
+                        help="Download all solutions again (ignore the state of the previous download in dest-dir).")
+    parser.add_argument("--refresh", default=False, action="store_true",
+                        help="Ignore cached API responses (if the response cache is configured), the cache is updated.")
+    parser.add_argument("--stats", type=str,
+                        help="Path to csv file where download statistics (bytes, times) of each solution are saved.")
     args = parser.parse_args()
 
     if args.manifest_per_file and not args.manifest and not args.dest_dir:
@@ -85,49 +262,12 @@ if __name__ == "__main__":
     if args.exercise not in config.get('exercises', {}):
         print("Invalid exercise identifier '{}'. Config holds exercises '{}'.".format(
             args.exercise, "', '".join(config['exercises'].keys())))
+        exit(1)
 
-    # Prepare destination directory
-    if args.dest_dir is not None:
-        pathlib.Path(args.dest_dir).mkdir(parents=True, exist_ok=True)
-        if not os.path.exists(args.dest_dir):
-            raise RuntimeError("Unable to create destination directory '{}'.".format(args.dest_dir))
-
-    # Prepare metadata handler which generates paths and saves manifest
-    metadata = MetadataHandler(args.dest_dir, config, os.path.dirname(config_file))
-    if args.manifest:
-        metadata.open_mainfest(args.manifest, args.manifest_per_file)
-
-    # Find assignments for selected exercise
-    exercise_id = config['exercises'][args.exercise]
-
-    # Iterate over all relevant groups, all their assignments, and all their solutions
-    print("Loading groups ...")
-    groups = get_groups(config.get('groups', []))
-    group_counter = 0
-    for group in groups:
-        group_counter += 1
-        metadata.set_group(group)
-        print("Loading assignments in group {} ({} of {}) ...".format(group['id'], group_counter, len(groups)))
-        assignments = recodex_api.get_assignments(group['id'], exercise_id)
-        assignment_counter = 0
-        for assignment in assignments:
-            metadata.set_assignment(assignment)
-            assignment_counter += 1
-            print(" - Loading list of solutions of assignment {} ({} of {}) ...".format(
-                assignment['id'], assignment_counter, len(assignments)))
-
-            solutions = recodex_api.get_solutions(assignment['id'], config.get('solutions', {}))
-            solution_counter = 0
-            for solution in solutions:
-                metadata.set_solution(solution)
-                solution_counter += 1
-                print("    - Processing solution {} ({} of {}) ..."
-                      .format(solution['id'], solution_counter, len(solutions)))
-
-                if args.dest_dir:  # Handle download
-                    path = metadata.get_path()  # of current solution
-                    recodex_api.download_solution(solution['id'], path, args.dest_dir)
-                metadata.write_manifest()  # of current solution
-
-    metadata.close_manifest()
+    recodex_api.set_rate_limit(args.rate_limit)
+    recodex_api.set_zip_streaming(args.stream_zip, args.zip_memory_limit)
+    for _ in download_solutions(config, args.exercise, args.dest_dir, args.manifest, args.manifest_per_file,
+                                os.path.dirname(config_file), jobs=args.jobs, stats=args.stats,
+                                resume=not args.no_resume, refresh=args.refresh, local_files=args.manifest_local_files):
+        pass
     print("And we're done here.")
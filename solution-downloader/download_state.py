@@ -0,0 +1,115 @@
+import os
+import json
+import hashlib
+
+STATE_FILE = '.download-state.jsonl'  # in the destination directory
+
+
+def _file_hash(file):
+    hash = hashlib.sha256()
+    with open(file, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            hash.update(chunk)
+    return hash.hexdigest()
+
+
+class DownloadState:
+    '''
+    Persistent record of completely downloaded solutions kept in the destination directory (one JSON line per solution
+    with its relative path and list of files with sizes, mtimes, and checksums). It allows to resume an interrupted
+    download -- solutions that are recorded and whose files are intact on disk are not downloaded again.
+    '''
+
+    def __init__(self, dest_dir, resume=True):
+        '''
+        Load the state file from the dest_dir (if resume is set, otherwise the old state is discarded).
+        '''
+        self.dest_dir = dest_dir
+        self.file = dest_dir + '/' + STATE_FILE
+        self.solutions = {}  # solution ID => last record
+
+        lines = 0
+        if resume and os.path.exists(self.file):
+            with open(self.file, 'r', encoding='utf8') as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # the last line may be incomplete (the process was killed while writing it)
+                    self.solutions[record['id']] = record
+                    lines += 1
+
+        if lines != len(self.solutions) or not resume:  # compact the file (drop outdated records)
+            tmp = self.file + '.tmp'
+            with open(tmp, 'w', encoding='utf8') as fp:
+                for record in self.solutions.values():
+                    fp.write(json.dumps(record) + '\n')
+            os.replace(tmp, self.file)
+
+        self.fp = open(self.file, 'a', encoding='utf8')
+
+    def _get_rel_path(self, path):
+        return os.path.relpath(path, self.dest_dir)
+
+    def scan(self, path):
+        '''
+        Return the file list (relative name => [size, mtime_ns, sha256]) of a downloaded solution directory.
+        '''
+        files = {}
+        for dir, _, names in os.walk(path):
+            for name in names:
+                file = dir + '/' + name
+                stat = os.stat(file)
+                files[os.path.relpath(file, path)] = [stat.st_size, stat.st_mtime_ns, _file_hash(file)]
+        return files
+
+    def _verify(self, path, files):
+        '''
+        Check that the directory holds exactly the recorded files with the same contents. Only files with modified
+        size or mtime are hashed.
+        '''
+        found = 0
+        for dir, _, names in os.walk(path):
+            for name in names:
+                file = dir + '/' + name
+                recorded = files.get(os.path.relpath(file, path))
+                if recorded is None:
+                    return False
+                stat = os.stat(file)
+                if stat.st_size != recorded[0]:
+                    return False
+                if stat.st_mtime_ns != recorded[1] and _file_hash(file) != recorded[2]:
+                    return False
+                found += 1
+        return found == len(files)
+
+    def is_complete(self, solution_id, path):
+        '''
+        True if the solution has been completely downloaded into the path. If the solution has been recorded under
+        a different path (e.g., the path config or the translated attributes have changed), it is moved first.
+        May be called from multiple threads, but only one thread may handle particular solution.
+        '''
+        record = self.solutions.get(solution_id)
+        if record is None:
+            return False
+
+        old_path = self.dest_dir + '/' + record['path']
+        if record['path'] != self._get_rel_path(path) and os.path.isdir(old_path) and not os.path.exists(path):
+            os.renames(old_path, path)
+
+        return os.path.isdir(path) and self._verify(path, record['files'])
+
+    def record(self, solution_id, path, files):
+        '''
+        Append a record of completely downloaded solution (files as returned by scan()).
+        The record is flushed immediately, so it survives if the process is interrupted.
+        '''
+        record = {'id': solution_id, 'path': self._get_rel_path(path), 'files': files}
+        self.solutions[solution_id] = record
+        self.fp.write(json.dumps(record) + '\n')
+        self.fp.flush()
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
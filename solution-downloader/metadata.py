@@ -1,6 +1,10 @@
 import unicodedata
+import copy
 import csv
 import os
+import json
+import time
+import threading
 import recodex_api
 from translator import AttributeTranslator
 from name_filter import NameFilter
@@ -22,15 +26,25 @@ class MetadataHandler:
     When all three parameters are set, user can get a path or write corresponding metadata to a CSV file.
     '''
 
-    def __init__(self, dest_dir, config, config_dir) -> None:
+    def __init__(self, dest_dir, config, config_dir, user_cache=None, local_files=False) -> None:
         '''
         The dest_dir is the directory where everything is downloaded, config a structure from parsed config.yaml.
         The config dir is the directory where config.yaml file was (used as a base dir for paths in the config)
+        The user_cache may be shared by multiple handlers (when the downloader is used as a library).
+        If the `user_cache` section is configured, users are also cached in a JSON file (for `ttl` seconds).
+        If local_files is set, per-file manifest rows are assembled from the downloaded files (not from the API).
         '''
         self.manifest_fp = None
         self.manifest_csv_writer = None
         self.manifest_per_file = None
-        self.user_cache = {}  # caching ID => user (so that we load each user only once from ReCodEx)
+        # caching ID => user (so that we load each user only once from ReCodEx)
+        self.user_cache = user_cache if user_cache is not None else {}
+        self.user_loaded = {}  # ID => timestamp when the user was loaded from ReCodEx (for the persistent cache)
+        user_cache_config = config.get('user_cache') or {}
+        self.user_cache_file = os.path.join(config_dir, user_cache_config['file']) \
+            if user_cache_config.get('file') else None
+        self.user_cache_ttl = user_cache_config.get('ttl', 86400)
+        self._load_user_cache()
 
         self.dest_dir = dest_dir
         self.manifest_config = config.get('manifest', {})
@@ -54,6 +68,13 @@ class MetadataHandler:
 
         self.name_filter = NameFilter(config.get('solutions', {}))
 
+        self.local_files = local_files
+        if local_files:
+            for column, parameter in self.manifest_config.items():
+                if parameter.split('.')[0] in ['file', 'zipEntry'] and parameter != 'file.name':
+                    raise RuntimeError("Manifest column '{}' references '{}' which is available only when files "
+                                       "are listed by ReCodEx API.".format(column, parameter))
+
     def _fetch(self, parameter, safe=False):
         '''
         Retrieve a metadata attribute based on a string descriptor `parameter`.
@@ -86,11 +107,54 @@ class MetadataHandler:
 
         return "/".join(map(mapper, self.path_config))
 
-    def _add_user_to_cache(self, user):
+    def _load_user_cache(self):
+        '''
+        Load users which are not expired from the persistent cache file (if configured and exists).
+        An unreadable or corrupted file is treated as an empty cache, malformed records (e.g., written by an older
+        version) are skipped. The file is overwritten at the end.
+        '''
+        if not self.user_cache_file or not os.path.exists(self.user_cache_file):
+            return
+        try:
+            with open(self.user_cache_file, 'r', encoding='utf-8') as fp:
+                cached = json.load(fp)
+        except (OSError, ValueError):
+            return
+        if not isinstance(cached, dict):
+            return
+        min_loaded = time.time() - self.user_cache_ttl
+        for record in cached.values():
+            if not isinstance(record, dict):
+                continue
+            user, loaded = record.get('user'), record.get('loaded')
+            if not isinstance(loaded, (int, float)) or not isinstance(user, dict) or 'id' not in user \
+                    or not isinstance(user.get('name'), dict):
+                continue  # malformed record
+            if loaded < min_loaded:
+                continue
+            if user['id'] in self.user_cache:  # shared in-memory cache holds the user already
+                self.user_loaded[user['id']] = loaded
+            else:
+                self._add_user_to_cache(user, loaded)
+
+    def save_user_cache(self):
+        '''
+        Save loaded users into the persistent cache file (if configured).
+        '''
+        if not self.user_cache_file:
+            return
+        cached = {id: {'loaded': loaded, 'user': self.user_cache[id]} for id, loaded in self.user_loaded.items()}
+        tmp = "{}.tmp{}-{}".format(self.user_cache_file, os.getpid(), threading.get_ident())  # concurrent runs
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            json.dump(cached, fp)
+        os.replace(tmp, self.user_cache_file)
+
+    def _add_user_to_cache(self, user, loaded=None):
         '''
         Augments the user object with computed values (normalized name strings) and saves it into the cache.
         '''
         self.user_cache[user['id']] = user
+        self.user_loaded[user['id']] = loaded or time.time()
         name = user.get('name', {})
         user['fullName'] = name.get('firstName') + " " + name.get('lastName')
         user['normFirstName'] = normalize_str(name.get('firstName')).lower()
@@ -106,6 +170,15 @@ class MetadataHandler:
 
         return self.user_cache[user_id]
 
+    def load_users(self, user_ids):
+        '''
+        Make sure given users are in the cache, all missing users are loaded by one bulk request.
+        '''
+        missing = list(dict.fromkeys(id for id in user_ids if id is not None and id not in self.user_cache))
+        if missing:
+            for user in recodex_api.get_users(missing):
+                self._add_user_to_cache(user)
+
     def _use_metadata_translators(self):
         for translator in self.translators:  # erase all first
             self.metadata[translator.get_name()] = None
@@ -119,9 +192,6 @@ class MetadataHandler:
         '''
         Update current metadata structure by setting current group (and related entities).
         '''
-        for student in recodex_api.get_students(group['id']):
-            self._add_user_to_cache(student)  # populate user cache (as an optimization)
-
         self.metadata['group'] = group
         admins = group.get('primaryAdminsIds', [])
         self.metadata['admin'] = self._get_user(admins[0]) if len(admins) > 0 else None
@@ -144,6 +214,16 @@ class MetadataHandler:
         self.metadata['path'] = None  # make sure path config does not reference itself
         self.metadata['path'] = self._get_path()
 
+    def snapshot(self):
+        '''
+        Return a copy of the handler that keeps current group, assignment, and solution, so it can be used
+        (e.g., to get path or manifest rows) in another thread while this handler moves on to the next solution.
+        Caches, translators, and the manifest file are shared.
+        '''
+        clone = copy.copy(self)
+        clone.metadata = dict(self.metadata)
+        return clone
+
     def open_mainfest(self, file, per_file=False):
         '''
         Open the manifest file and write in the header line.
@@ -175,49 +255,92 @@ class MetadataHandler:
             path = self.dest_dir + "/" + path
         return path
 
-    def _write_manifest_row(self):
-        row = map(lambda p: self._fetch(p, True), self.manifest_config.values())
-        self.manifest_csv_writer.writerow(row)
+    def _get_manifest_row(self):
+        return {column: self._fetch(p, True) for column, p in self.manifest_config.items()}
 
-    def write_manifest(self):
+    def _get_local_files(self):
+        '''
+        Return relative paths of all files in the (downloaded) directory of the solution.
+        '''
+        root = self.get_path()
+        files = []
+        for dir, _, names in os.walk(root):
+            files += [os.path.relpath(dir + '/' + name, root) for name in names]
+        return files
+
+    def _get_local_manifest_rows(self, files):
+        rows = []
+        path = self.metadata['path']  # save solution path
+        for file_name in sorted(files):
+            if not self.name_filter.valid_name(file_name):
+                print("File {} was filtered out.".format(file_name))
+                continue
+
+            self.metadata['path'] = path + '/' + file_name
+            self.metadata['fileName'] = file_name
+            self.metadata['file'] = {'name': file_name}
+            rows.append(self._get_manifest_row())
+
+        self.metadata['path'] = path  # restore the path
+        self.metadata.pop('file', None)
+        self.metadata.pop('fileName', None)
+        return rows
+
+    def get_manifest_rows(self, per_file=False, files=None):
+        '''
+        Return solution metadata as manifest rows (dicts column => value) based on the configuration
+        and last set solution, group, and assignment.
+        If the per_file is set, one row per each solution file is returned. The files are listed by ReCodEx API,
+        or (if local_files is set) taken from given list of relative paths (e.g., entries of the downloaded zip)
+        or from the downloaded directory of the solution.
+        '''
+        if not per_file:
+            return [self._get_manifest_row()]
+
+        if self.local_files:
+            return self._get_local_manifest_rows(files if files is not None else self._get_local_files())
+
+        rows = []
+        path = self.metadata['path']  # save solution path
+
+        for file in recodex_api.get_solution_files(self.metadata['solution']['id']):
+            self.metadata['file'] = file
+            if 'zipEntries' in file:
+                for entry in file['zipEntries']:
+                    file_name = file['name'] + '#' + entry['name']
+                    if not self.name_filter.valid_name(file_name):
+                        print("File {} was filtered out.".format(file_name))
+                        continue
+
+                    self.metadata['path'] = path + '/' + entry['name']
+                    self.metadata['fileName'] = file_name
+                    self.metadata['zipEntry'] = entry
+                    rows.append(self._get_manifest_row())
+
+            else:
+                if not self.name_filter.valid_name(file['name']):
+                    print("File {} was filtered out.".format(file['name']))
+                    continue
+
+                self.metadata['path'] = path + '/' + file['name']
+                self.metadata['fileName'] = file['name']
+                rows.append(self._get_manifest_row())
+
+        self.metadata['path'] = path  # restore the path
+        self.metadata.pop('file', None)
+        self.metadata.pop('fileName', None)
+        self.metadata.pop('zipEntry', None)
+        return rows
+
+    def write_manifest(self, rows=None):
         '''
         If the manifest is being saved, write solution metadata into CSV as one line
         (based on the configuration and last set solution, group, and assignment).
         If the manifest_per_file, one line per each downloaded file is written.
+        Rows that have been already assembled by get_manifest_rows() may be passed.
         '''
         if self.manifest_fp is not None:
-            if self.manifest_per_file:
-                pwd = os.getcwd()
-                # os.chdir(self.get_path()) # TODO - check whether mainfest files really exist
-                path = self.metadata['path']  # save solution path
-
-                for file in recodex_api.get_solution_files(self.metadata['solution']['id']):
-                    self.metadata['file'] = file
-                    if 'zipEntries' in file:
-                        for entry in file['zipEntries']:
-                            file_name = file['name'] + '#' + entry['name']
-                            if not self.name_filter.valid_name(file_name):
-                                print("File {} was filtered out.".format(file_name))
-                                continue
-
-                            self.metadata['path'] = path + '/' + entry['name']
-                            self.metadata['fileName'] = file_name
-                            self.metadata['zipEntry'] = entry
-                            self._write_manifest_row()
-
-                    else:
-                        if not self.name_filter.valid_name(file['name']):
-                            print("File {} was filtered out.".format(file['name']))
-                            continue
-
-                        self.metadata['path'] = path + '/' + file['name']
-                        self.metadata['fileName'] = file['name']
-                        self._write_manifest_row()
-
-                self.metadata['path'] = path  # restore the path
-                self.metadata.pop('file', None)
-                self.metadata.pop('fileName', None)
-                self.metadata.pop('zipEntry', None)
-                os.chdir(pwd)
-            else:
-                self._write_manifest_row()
+            if rows is None:
+                rows = self.get_manifest_rows(self.manifest_per_file)
+            for row in rows:
+                self.manifest_csv_writer.writerow(row.values())
@@ -4,19 +4,203 @@ import os
 import zipfile
 import shutil
 import time
+import io
+import tempfile
+import threading
+import hashlib
+import json
 from ruamel.yaml import YAML
+try:
+    import orjson  # optional, faster parser of JSON outputs
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 group_cache = None
+assignment_cache = {}  # group ID => all assignments of the group
+_cache_reset_at = None  # when the in-memory caches were reset (the module may stay loaded in a resident process)
+_backend = 'cli'  # 'cli' (recodex process per call) or 'client' (in-process client with persistent connections)
+_thread_data = threading.local()  # each worker thread keeps its own client (and its connection pool)
 
 # Low level functions for calling ReCodEx CLI process
 
 
-def _recodex_call(args):
+class _RateLimiter:
     '''
-    Invoke recodex CLI process with given set of arguments.
+    Spreads API calls evenly in time (at most `rate` calls per second), thread safe.
+    All calls go to the same API server (the one the CLI is logged in), so one limiter protects the whole host.
+    '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_call = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            call_at = max(now, self.next_call)
+            self.next_call = call_at + self.interval
+        if call_at > now:
+            time.sleep(call_at - now)
+
+
+class _ResponseCache:
+    '''
+    On-disk cache of CLI outputs of read commands, keyed by the command and its arguments.
+    Each command (first two arguments, e.g., 'groups all') has its own TTL, commands without TTL are not cached.
+    Entries expire by their mtime (when they were written), the atime is updated on hits and the least recently used
+    entries are evicted when the total size exceeds max_size. Thread safe, the directory may be also shared by multiple
+    processes (the size is only an estimate, it is recomputed from the directory before eviction).
+    '''
+
+    def __init__(self, dir, ttls, max_size, refresh=False):
+        self.dir = dir
+        self.ttls = ttls
+        self.max_size = max_size
+        self.refresh = refresh  # entries are not read (only written), so all data are loaded again
+        self.lock = threading.Lock()
+        os.makedirs(dir, exist_ok=True)
+        self.size = sum(stat.st_size for _, stat in self._get_files())
+
+    def _get_files(self):
+        '''
+        Yield (file, stat) of all entries (files removed concurrently by other processes are skipped).
+        '''
+        for dir, _, files in os.walk(self.dir):
+            for file in files:
+                if not file.endswith('.tmp'):
+                    try:
+                        yield dir + '/' + file, os.stat(dir + '/' + file)
+                    except FileNotFoundError:
+                        pass
+
+    def _get_file(self, args):
+        key = hashlib.sha256(json.dumps(args).encode('utf8')).hexdigest()
+        return self.dir + '/' + key[:2] + '/' + key
+
+    def get_ttl(self, args):
+        return self.ttls.get(' '.join(args[:2]))
+
+    def load(self, args):
+        '''
+        Return cached output of given command (None if not cached or expired).
+        '''
+        ttl = self.get_ttl(args)
+        if not ttl or self.refresh:
+            return None
+        file = self._get_file(args)
+        try:
+            stat = os.stat(file)
+            if stat.st_mtime + ttl < time.time():
+                return None
+            with open(file, 'rb') as fp:
+                payload = fp.read()
+            os.utime(file, ns=(time.time_ns(), stat.st_mtime_ns))  # atime marks the last use (for LRU)
+            return payload
+        except OSError:
+            return None  # missing (or concurrently evicted)
+
+    def store(self, args, payload):
+        '''
+        Save output of given command (if it is cacheable) and evict least recently used entries if necessary.
+        '''
+        if not self.get_ttl(args):
+            return
+        file = self._get_file(args)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        tmp = "{}.{}-{}.tmp".format(file, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as fp:
+            fp.write(payload)
+        with self.lock:
+            try:
+                old_size = os.path.getsize(file)
+            except FileNotFoundError:
+                old_size = 0
+            os.replace(tmp, file)
+            self.size += len(payload) - old_size
+            if self.size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted((stat.st_atime, stat.st_size, file) for file, stat in self._get_files())
+        self.size = sum(size for _, size, _ in entries)  # other processes may have stored or evicted entries
+        for _, size, file in entries:
+            if self.size <= self.max_size * 0.9:  # leave some room, so the eviction does not run after each store
+                break
+            try:
+                os.unlink(file)
+            except FileNotFoundError:
+                pass  # evicted by another process
+            self.size -= size
+
+
+# TTLs [s] of cached CLI commands (files of a solution never change; the listings of solutions change as students
+# submit, so they are not cached -- a stale listing would hide new solutions from the download)
+RESPONSE_CACHE_TTLS = {
+    'groups all': 3600,
+    'groups assignments': 3600,
+    'users get': 86400,
+    'solutions get-files': 30 * 86400,
+}
+
+_rate_limiter = None
+_response_cache = None
+_zip_streaming = False  # zip archives are piped from the CLI (not saved into the download dir first)
+_zip_memory_limit = 16 * 1024 * 1024  # streamed archives larger than this are spooled to a temporary file
+
+
+def set_rate_limit(rate):
+    '''
+    Limit the number of API calls per second (None or 0 = no limit).
+    '''
+    global _rate_limiter
+    _rate_limiter = _RateLimiter(rate) if rate else None
+
+
+def set_zip_streaming(enabled, memory_limit=None):
+    '''
+    Enable/disable streaming of downloaded zip archives (the CLI writes the archive to its stdout,
+    which is buffered in memory up to memory_limit bytes and then in a temporary file).
+    '''
+    global _zip_streaming, _zip_memory_limit
+    _zip_streaming = enabled
+    if memory_limit is not None:
+        _zip_memory_limit = memory_limit
+
+
+def set_response_cache(dir, ttls=None, max_size=64 * 1024 * 1024, refresh=False):
+    '''
+    Enable on-disk cache of CLI outputs of read commands (None dir disables the cache).
+    The ttls (command => seconds) override the defaults, refresh means cached entries are not used (but updated).
+    '''
+    global _response_cache
+    _response_cache = _ResponseCache(dir, dict(RESPONSE_CACHE_TTLS, **(ttls or {})), max_size, refresh) \
+        if dir else None
+
+
+def set_backend(backend):
+    '''
+    Select how the API calls are performed ('cli' or 'client').
+    '''
+    global _backend
+    if backend not in ['cli', 'client']:
+        raise RuntimeError("Unknown ReCodEx API backend '{}'.".format(backend))
+    _backend = backend
+
+
+def _throttle():
+    if _rate_limiter is not None:
+        _rate_limiter.wait()
+
+
+def _recodex_call(args, input=None):
+    '''
+    Invoke recodex CLI process with given set of arguments (and input bytes passed to its stdin).
     On success, stdout is returned as string. On error, None is returned and the message is printed out.
     '''
-    res = subprocess.run(['recodex'] + args, capture_output=True)
+    _throttle()
+    res = subprocess.run(['recodex'] + args, input=input, capture_output=True)
     if res.returncode == 0:
         return res.stdout
     else:
@@ -25,19 +209,88 @@ def _recodex_call(args):
         return None
 
 
+def _get_client():
+    '''
+    Return in-process ReCodEx client of the current thread (created lazily from the session of the CLI tool).
+    The client keeps its connections alive, so subsequent calls do not pay for new TLS handshakes.
+    '''
+    client = getattr(_thread_data, 'client', None)
+    if client is None:
+        try:
+            from recodex import client_factory
+        except ImportError:
+            raise RuntimeError("The 'client' backend requires recodex-pylib (see requirements-client.txt).")
+        client = client_factory.get_client_from_session()
+        _thread_data.client = client
+    return client
+
+
+def _client_call(callback, **kwargs):
+    '''
+    Perform a request using the in-process client, callback is a name of DefaultApi method.
+    Returns the response, on error None is returned and the message is printed out.
+    '''
+    client = _get_client()
+    from recodex.generated.swagger_client import DefaultApi
+    _throttle()
+    try:
+        return client.send_request_by_callback(getattr(DefaultApi, callback), **kwargs)
+    except Exception as e:
+        sys.stderr.write("Error calling ReCodEx API ({}): {}\n".format(callback, e))
+        return None
+
+
+def _parse_payload(payload):
+    '''
+    Parse output of the CLI. The outputs are requested in JSON (much faster to parse than YAML),
+    YAML parser is used as a fallback (if the CLI does not produce JSON).
+    '''
+    try:
+        return _json_loads(payload)
+    except ValueError:  # both json.JSONDecodeError and orjson.JSONDecodeError are ValueErrors
+        yaml = YAML(typ="safe")
+        return yaml.load(payload)
+
+
+def _read_call(args, callback, **kwargs):
+    '''
+    Perform a read call using selected backend -- either CLI with given args, or in-process client with given
+    callback (DefaultApi method name) and request parameters (path_params, query_params, ...).
+    Results are taken from the response cache (if enabled, keyed by the CLI args). Returns parsed payload or None.
+    '''
+    if _response_cache is not None:
+        payload = _response_cache.load(args)
+        if payload is not None:
+            return _parse_payload(payload)
+
+    if _backend == 'client':
+        response = _client_call(callback, **kwargs)
+        if response is None:
+            return None
+        result = response.get_payload()
+        payload = json.dumps(result).encode('utf8') if _response_cache is not None else None
+    else:
+        payload = _recodex_call(args)
+        if payload is None:
+            return None
+        result = _parse_payload(payload)
+
+    if _response_cache is not None and result is not None:  # failures (e.g., unknown entities) are not cached
+        _response_cache.store(args, payload)
+    return result
+
+
 def _get_all_groups(archived=False):
     '''
     Load all groups and return them in a dictionary indexed by group IDs.
     '''
 
-    args = ['groups', 'all']
+    args = ['groups', 'all', '--json']
     if archived:
         args.append('--archived')
-    payload = _recodex_call(args)
-    if payload is None:
+    groups = _read_call(args, 'groups_presenter_action_default', query_params={'archived': archived})
+    if groups is None:
         raise Exception("Error reading groups list.")
-    yaml = YAML(typ="safe")
-    groups = yaml.load(payload)
 
     res = {}
     for group in groups:
@@ -46,6 +299,19 @@ def _get_all_groups(archived=False):
     return res
 
 
+def reset_caches(max_age=0):
+    '''
+    Drop in-memory caches of groups and assignments unless they are younger than max_age seconds.
+    The reference time of the maxAge solution filter is always reset (it is fixed only within one download).
+    '''
+    global group_cache, assignment_cache, _cache_reset_at, _max_age_ts
+    _max_age_ts = None
+    if _cache_reset_at is None or time.time() - _cache_reset_at >= max_age:
+        group_cache = None
+        assignment_cache = {}
+        _cache_reset_at = time.time()
+
+
 def get_relevant_groups(group_id, recursive, archived=False):
     '''
     Get all groups which are children/descendants (based on recursive flag) of given root group.
@@ -76,37 +342,48 @@ def get_user(user_id):
     '''
     Load data of one user of particular ID.
     '''
-    payload = _recodex_call(['users', 'get', user_id, '--yaml'])
-    if payload is None:
+    user = _read_call(['users', 'get', user_id, '--json'], 'users_presenter_action_detail',
+                      path_params={'id': user_id})
+    if user is None:
         raise Exception("Error loading user {}.".format(user_id))
 
-    yaml = YAML(typ="safe")
-    return yaml.load(payload)
+    return user
 
 
-def get_students(group_id):
+def get_users(user_ids, chunk_size=500):
     '''
-    Return students of a particular group.
+    Load data of multiple users (list of IDs) using bulk requests (`users get-list` of the CLI reads the IDs
+    from its stdin, the in-process client is used only by the 'client' backend).
+    Returns a list of users (users that do not exist are missing).
     '''
-    payload = _recodex_call(['groups', 'students', group_id, '--yaml'])
-    if payload is None:
-        raise Exception("Error reading students of group {}.".format(group_id))
-
-    yaml = YAML(typ="safe")
-    return yaml.load(payload)
+    res = []
+    for i in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[i:i + chunk_size]
+        if _backend == 'client':
+            response = _client_call('users_presenter_action_list_by_ids', body={"ids": chunk})
+            users = response.get_payload() if response is not None else None
+        else:
+            payload = _recodex_call(['users', 'get-list', '--json'], input='\n'.join(chunk).encode('utf8'))
+            users = _parse_payload(payload) if payload is not None else None
+        if users is None:
+            raise Exception("Error loading users.")
+        res += users
+    return res
 
 
 def get_assignments(group_id, exercise_id):
     '''
     Load all assignments of given group and return id of the first one that matches given exercise.
     '''
-    payload = _recodex_call(['groups', 'assignments', group_id, '--yaml'])
-    if payload is None:
-        raise Exception("Error reading assignments of group.")
+    assignments = assignment_cache.get(group_id)
+    if assignments is None:
+        assignments = _read_call(['groups', 'assignments', group_id, '--json'], 'groups_presenter_action_assignments',
+                                 path_params={'id': group_id})
+        if assignments is None:
+            raise Exception("Error reading assignments of group.")
+        assignment_cache[group_id] = assignments
 
     res = []
-    yaml = YAML(typ="safe")
-    assignments = yaml.load(payload)
     for assignment in assignments:
         if assignment.get('exerciseId', None) == exercise_id:
             res.append(assignment)
@@ -169,11 +446,10 @@ def get_solutions(assignment_id, config):
     '''
     Load all solutions of given assignment and filter only accepted ones.
     '''
-    payload = _recodex_call(['assignments', 'get-solutions', assignment_id, '--yaml'])
-    if payload is None:
+    solutions = _read_call(['assignments', 'get-solutions', assignment_id, '--json'],
+                           'assignments_presenter_action_solutions', path_params={'id': assignment_id})
+    if solutions is None:
         raise Exception("Error reading solutions of an assignment.")
-    yaml = YAML(typ="safe")
-    solutions = yaml.load(payload)
     result = []
     for solution in solutions:
         if _filter_solution(solution, config):
@@ -182,29 +458,99 @@ def get_solutions(assignment_id, config):
     return result
 
 
+def _stream_solution_zip(solution_id, zip_dir):
+    '''
+    Download the zip archive of a solution through the stdout of the CLI. The archive is buffered in memory,
+    archives larger than the memory limit are moved into a temporary file in zip_dir (tempfile.SpooledTemporaryFile
+    cannot be used, zipfile needs seekable() which it has only since Python 3.11).
+    Returns the archive (file-like object positioned at the beginning) and its size.
+    '''
+    _throttle()
+    archive = io.BytesIO()
+    try:
+        with tempfile.TemporaryFile() as stderr:  # not a pipe, the CLI must not block on a full stderr
+            process = subprocess.Popen(['recodex', 'solutions', 'download', solution_id, '/dev/stdout'],
+                                       stdout=subprocess.PIPE, stderr=stderr)
+            size = 0
+            for chunk in iter(lambda: process.stdout.read(1024 * 1024), b''):
+                size += len(chunk)
+                if size > _zip_memory_limit and isinstance(archive, io.BytesIO):
+                    spooled = tempfile.TemporaryFile(dir=zip_dir)
+                    spooled.write(archive.getbuffer())
+                    archive = spooled
+                archive.write(chunk)
+            process.stdout.close()
+            if process.wait() != 0:
+                stderr.seek(0)
+                sys.stderr.write("Error calling recodex CLI:\n")
+                sys.stderr.buffer.write(stderr.read())
+                raise RuntimeError("Download of solution {} failed!".format(solution_id))
+    except BaseException:
+        archive.close()
+        raise
+    archive.seek(0)
+    return archive, size
+
+
 def download_solution(solution_id, dir, zip_dir):
     '''
-    Download a solution (into `zip_dir`) and extract it into target `dir`.
-    The downloaded zip is deleted after extraction.
+    Download a solution and extract it into target `dir`. The zip archive is either loaded by the in-process client
+    (into memory), streamed from the CLI (into a memory buffer, large archives are spooled into a temporary file
+    in `zip_dir`), or saved into `zip_dir` and deleted after extraction. Returns statistics of the download
+    (bytes, download and extraction times in seconds, and whether the archive was kept in memory)
+    and the list of extracted files (relative paths).
     '''
+    start = time.monotonic()
     zip_file = "{}/{}.zip".format(zip_dir, solution_id)
-    _recodex_call(['solutions', 'download', solution_id, zip_file])
-    if not os.path.exists(zip_file):
-        raise RuntimeError("Download of {} failed!".format(zip_file))
+    if _backend == 'client':
+        response = _client_call('assignment_solutions_presenter_action_download_solution_archive',
+                                path_params={'id': solution_id})
+        if response is None:
+            raise RuntimeError("Download of solution {} failed!".format(solution_id))
+        data = response.get_data_binary()
+        archive = io.BytesIO(data)  # the client holds the whole response in memory anyway
+        size = len(data)
+        in_memory = True
+    elif _zip_streaming:
+        archive, size = _stream_solution_zip(solution_id, zip_dir)
+        in_memory = isinstance(archive, io.BytesIO)  # larger archives have been moved to disk
+    else:
+        _recodex_call(['solutions', 'download', solution_id, zip_file])
+        if not os.path.exists(zip_file):
+            raise RuntimeError("Download of {} failed!".format(zip_file))
+        archive = zip_file
+        size = os.path.getsize(zip_file)
+        in_memory = False
+    downloaded = time.monotonic()
 
     # unzip
-    if os.path.exists(dir):
-        shutil.rmtree(dir)
-    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-        zip_ref.extractall(dir)
-
-    os.unlink(zip_file)
+    try:
+        if os.path.exists(dir):
+            shutil.rmtree(dir)
+        with zipfile.ZipFile(archive, 'r') as zip_ref:
+            zip_ref.extractall(dir)
+            files = [name for name in zip_ref.namelist() if not name.endswith('/')]  # from the central directory
+    finally:
+        if archive is not zip_file:
+            archive.close()
+        elif os.path.exists(zip_file):
+            os.unlink(zip_file)
+
+    return {
+        'bytes': size,
+        'download_time': downloaded - start,
+        'extract_time': time.monotonic() - downloaded,
+        'in_memory': in_memory,
+        'files': files,
+    }
 
 
 def get_solution_files(solution_id):
     '''
     Retrieve a list of submitted files for given solution.
     '''
-    payload = _recodex_call(['solutions', 'get-files', solution_id, '--yaml'])
-    yaml = YAML(typ="safe")
-    return yaml.load(payload)
+    files = _read_call(['solutions', 'get-files', solution_id, '--json'],
+                       'assignment_solutions_presenter_action_files', path_params={'id': solution_id})
+    if files is None:
+        raise Exception("Error reading files of solution {}.".format(solution_id))
+    return files